@@ -1,5 +1,12 @@
+import codecs
+import datetime
+import email.utils
 import json
+import random
 import requests
+import sys
+import threading
+import time
 import urllib
 try:
     from urllib.parse import quote as url_quote
@@ -7,6 +14,23 @@ except:
     from urllib import quote as url_quote
 
 TOGGL_API_VERSION = 'v6'
+TOGGL_REPORTS_URL = 'https://toggl.com/reports/api/v2'
+TOGGL_USER_AGENT = 'toggl-cli'
+DEFAULT_MAX_WORKERS = 4
+STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_WINDOW = datetime.timedelta(days=7)
+
+# Request scheduling defaults; Toggl allows about one request per second per
+# API token, with short bursts tolerated.
+DEFAULT_RATE            = 1.0
+DEFAULT_BURST           = 3
+DEFAULT_MAX_CONCURRENT  = 2
+DEFAULT_MAX_RETRIES     = 5
+DEFAULT_BACKOFF         = 0.5
+DEFAULT_MAX_BACKOFF     = 30.0
+# Longest verbose log line; longer ones, usually response bodies, are cut.
+VERBOSE_LIMIT = 2000
+IDEMPOTENT_METHODS      = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
 
 KEY_ID          = 'id'
 KEY_NAME        = 'name'
@@ -33,6 +57,446 @@ KEY_IGNTIMES    = 'ignore_start_and_stop'
 KEY_ESTSECS     = 'estimated_seconds'
 KEY_TASK        = 'task'
 
+def parallel_map(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """Calls func on every item using up to max_workers threads and returns
+       the results in the order of items. The first exception raised by a
+       call is re-raised in the caller once all workers have stopped."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    pending = iter(range(len(items)))
+
+    def worker():
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    i = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+                return
+
+    threads = [threading.Thread(target=worker)
+            for n in range(min(max_workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        exc_type, exc, tb = errors[0]
+        raise exc
+    return results
+
+_json_decoder = json.JSONDecoder()
+
+def iter_json_array(chunks, key='data'):
+    """Yields the elements of the array stored under key in a JSON object
+       that arrives as a sequence of byte chunks, decoding one element at a
+       time so the whole document is never held in memory."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def fill():
+        """Reads another chunk; returns False at the end of the input."""
+        if state['eof']:
+            return False
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            state['eof'] = True
+            chunk = b''
+        text = decoder.decode(chunk, final=state['eof'])
+        state['buf'] = state['buf'][state['pos']:] + text
+        state['pos'] = 0
+        return True
+
+    def peek():
+        """Returns the next non-blank character without consuming it."""
+        while True:
+            buf, pos = state['buf'], state['pos']
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError("Expected %r in JSON stream" % char)
+        state['pos'] += 1
+
+    def value():
+        """Decodes the next complete JSON value, reading more as needed."""
+        peek()
+        while True:
+            try:
+                obj, end = _json_decoder.raw_decode(state['buf'], state['pos'])
+                # A number could still continue in the next chunk.
+                if state['eof'] or not isinstance(obj, (int, float)) or \
+                        (end < len(state['buf']) and state['buf'][end] not in '0123456789.eE+-'):
+                    state['pos'] = end
+                    return obj
+            except ValueError:
+                if state['eof']:
+                    raise
+            fill()
+
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        name = value()
+        expect(':')
+        if name == key and peek() == '[':
+            state['pos'] += 1
+            if peek() == ']':
+                return
+            while True:
+                yield value()
+                if peek() == ',':
+                    state['pos'] += 1
+                    continue
+                return
+        value()
+        if peek() != ',':
+            return
+        state['pos'] += 1
+
+class TogglCannedResponse:
+    """A response whose body has been read in full, as recorded to or
+       replayed from a cassette. Offers the parts of requests.Response that
+       TogglApi uses."""
+
+    def __init__(self, method, url, status_code, headers, text):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.retries = 0
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("%d Error for url: %s" % (self.status_code, self.url),
+                    response=self)
+
+    def close(self):
+        pass
+
+    def to_json(self, data=None):
+        return {'method': self.method, 'url': self.url, 'data': data,
+                'status': self.status_code, 'headers': dict(self.headers),
+                'body': self.text}
+
+class TogglReplayMiss(requests.RequestException):
+    """A replayed request has no recorded response."""
+
+class TogglTransport:
+    """Sends the scheduler's HTTP requests. The base transport uses the
+       network, optionally sleeping latency seconds before each request to
+       simulate a slow link. paced tells the scheduler whether to apply its
+       rate limit and retry delays."""
+
+    paced = True
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def send(self, method, url, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return requests.request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+# Response headers that carry credentials or sessions, left out of cassettes.
+UNRECORDED_HEADERS = ['set-cookie', 'cookie', 'authorization',
+    'proxy-authorization', 'www-authenticate']
+
+class TogglRecordingTransport(TogglTransport):
+    """Sends requests over the network and appends each exchange to a
+       JSON-lines cassette. Credentials and session cookies are not
+       recorded. Each response is read in full before it is returned, so
+       streamed responses lose their constant memory while recording."""
+
+    def __init__(self, path, latency=0):
+        TogglTransport.__init__(self, latency)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def send(self, method, url, **kwargs):
+        r = TogglTransport.send(self, method, url, **kwargs)
+        try:
+            headers = dict((k, v) for k, v in r.headers.items()
+                    if k.lower() not in UNRECORDED_HEADERS)
+            canned = TogglCannedResponse(method.upper(), url, r.status_code,
+                    headers, r.text)
+        finally:
+            r.close()
+        with self._lock:
+            self._file.write(json.dumps(canned.to_json(kwargs.get('data'))) + "\n")
+            self._file.flush()
+        return canned
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class TogglReplayTransport(TogglTransport):
+    """Answers requests from a cassette without touching the network.
+       Requests are matched on method, URL and body; repeats of a request
+       get its recorded responses in order, the last one repeating once they
+       run out. The scheme and host are ignored, so a cassette recorded
+       against one server replays against any. A request whose URL differs
+       only in its query string, such as a default date range computed on
+       another day, falls back to the responses recorded for the same method
+       and path."""
+
+    paced = False
+
+    def __init__(self, path, latency=0):
+        TogglTransport.__init__(self, latency)
+        self._exact = {}
+        self._by_path = {}
+        self._lock = threading.Lock()
+        f = open(path, "r")
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            url = self._relative(rec['url'])
+            self._exact.setdefault((rec['method'], url, rec['data']), []).append(rec)
+            self._by_path.setdefault((rec['method'], url.split('?')[0]), []).append(rec)
+        f.close()
+        self._next = {}
+
+    @staticmethod
+    def _relative(url):
+        if '://' in url:
+            url = '/' + url.split('/', 3)[-1]
+        return url
+
+    def _take(self, key, recs):
+        with self._lock:
+            i = self._next.get(key, 0)
+            self._next[key] = i + 1
+        return recs[min(i, len(recs) - 1)]
+
+    def send(self, method, url, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        method = method.upper()
+        key = (method, self._relative(url), kwargs.get('data'))
+        if key in self._exact:
+            rec = self._take(key, self._exact[key])
+        else:
+            key = (method, key[1].split('?')[0])
+            if key not in self._by_path:
+                raise TogglReplayMiss("No recorded response for %s %s" % (method, url))
+            rec = self._take(key, self._by_path[key])
+        return TogglCannedResponse(method, url, rec['status'], rec['headers'], rec['body'])
+
+def endpoint_template(url):
+    """Returns the path of an API URL with ids replaced by {id} and without
+       the query, e.g. /api/v6/time_entries/{id}.json, to group requests."""
+    path = url.split('?')[0]
+    if '://' in path:
+        path = '/' + path.split('/', 3)[-1]
+    parts = []
+    for part in path.split('/'):
+        name, dot, ext = part.partition('.')
+        if name.isdigit():
+            part = '{id}' + dot + ext
+        parts.append(part)
+    return '/'.join(parts)
+
+class TogglScheduler:
+    """Paces the HTTP requests made by TogglApi.
+
+    A token bucket limits the request rate, a semaphore caps the number of
+    requests in flight and failed requests are retried with jittered
+    exponential backoff. 429 responses are always retried, honoring
+    Retry-After across all threads; server errors and connection failures
+    are only retried for idempotent methods.
+
+    Each finished request, including one that failed for good, is passed
+    to the hooks as a dict with its method, endpoint template, status (None
+    after a connection error), latency in seconds over all attempts,
+    request and response bytes (None when a streamed response has no
+    Content-Length) and retry count."""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+            max_concurrent=DEFAULT_MAX_CONCURRENT, max_retries=DEFAULT_MAX_RETRIES,
+            backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF, transport=None):
+        self.transport = transport if transport is not None else TogglTransport()
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self.hooks = []
+
+    def _acquire_token(self):
+        """Blocks until the bucket has a token for the next request."""
+        while True:
+            with self._lock:
+                now = time.time()
+                if self.rate > 0:
+                    self._tokens = min(self.burst,
+                            self._tokens + (now - self._last) * self.rate)
+                else:
+                    self._tokens = self.burst
+                self._last = now
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _sleep(self, seconds):
+        if self.transport.paced:
+            time.sleep(seconds)
+
+    def _block(self, seconds):
+        """Holds back every request until seconds from now."""
+        if not self.transport.paced:
+            return
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.time() + seconds)
+
+    def retry_after(self, r):
+        """Returns the delay asked for by a Retry-After header, or None."""
+        value = r.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+    def backoff_delay(self, attempt):
+        """Full-jitter exponential backoff for the given retry attempt."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def _emit(self, method, url, kwargs, started, attempt, r=None, error=None):
+        if not self.hooks:
+            return
+        resp_bytes = None
+        if r is not None:
+            length = r.headers.get('Content-Length')
+            if length is not None:
+                resp_bytes = int(length)
+            elif not kwargs.get('stream'):
+                resp_bytes = len(r.content)
+        data = kwargs.get('data') or b''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        event = {'time': started, 'method': method.upper(),
+                'endpoint': endpoint_template(url),
+                'status': r.status_code if r is not None else None,
+                'latency': time.time() - started,
+                'request_bytes': len(data),
+                'response_bytes': resp_bytes, 'retries': attempt,
+                'error': error}
+        for hook in self.hooks:
+            hook(event)
+
+    def request(self, method, url, **kwargs):
+        """Sends the request, retrying as described above, and returns the
+           last response. Raises the last connection error if retries run
+           out."""
+        started = time.time()
+        try:
+            r = self._send(method, url, kwargs)
+        except requests.RequestException as e:
+            self._emit(method, url, kwargs, started, getattr(e, 'retries', 0),
+                    error=e.__class__.__name__)
+            raise
+        self._emit(method, url, kwargs, started, r.retries, r)
+        return r
+
+    def _send(self, method, url, kwargs):
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            if self.transport.paced:
+                self._acquire_token()
+            try:
+                with self._slots:
+                    r = self.transport.send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    e.retries = attempt
+                    raise
+                self._sleep(self.backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            if r.status_code == 429 and attempt < self.max_retries:
+                delay = self.retry_after(r)
+                if delay is None:
+                    delay = self.backoff_delay(attempt)
+                self._block(delay)
+            elif r.status_code >= 500 and idempotent and attempt < self.max_retries:
+                delay = self.retry_after(r)
+                self._sleep(delay if delay is not None else self.backoff_delay(attempt))
+            else:
+                r.retries = attempt
+                return r
+            attempt += 1
+
+class TogglPrefetch:
+    """Runs func(*args) in a background thread; result() waits for it and
+       returns its value or re-raises its exception."""
+
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func,) + args)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, *args):
+        try:
+            self._result = func(*args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error[1]
+        return self._result
+
 class TogglRawData:
     def __init__(self):
         self._url = None
@@ -64,11 +528,33 @@ class TogglRawData:
         self._respdata = value
 
 class TogglApi:
-    def __init__(self, url, auth, api_version=TOGGL_API_VERSION, verbose=False):
+    def __init__(self, url, auth, api_version=TOGGL_API_VERSION, verbose=False,
+            scheduler=None, reports_url=TOGGL_REPORTS_URL):
         self.base_url = '%s/%s' % (url, api_version)
+        self.reports_url = reports_url
         self.auth = auth
         self.verbose = verbose
         self.headers = {'content-type': 'application/json'}
+        self.scheduler = scheduler if scheduler is not None else TogglScheduler()
+        if verbose:
+            self.scheduler.hooks.append(self._log_event)
+
+    def log(self, text):
+        """Writes verbose output to stderr, away from command output."""
+        text = str(text)
+        if len(text) > VERBOSE_LIMIT:
+            text = "%s... (%d more characters)" % (text[:VERBOSE_LIMIT], len(text) - VERBOSE_LIMIT)
+        sys.stderr.write(text + "\n")
+
+    def _log_event(self, event):
+        self.log("%s %s -> %s in %.3fs, %s bytes, %d retries" % (event['method'],
+            event['endpoint'], event['status'] or event['error'], event['latency'],
+            event['response_bytes'] if event['response_bytes'] is not None else '?',
+            event['retries']))
+
+    def _request(self, method, url, **kwargs):
+        """Sends an authenticated request through the scheduler."""
+        return self.scheduler.request(method, url, auth=self.auth, **kwargs)
 
     def _raise_if_error(self, r):
         if r.status_code != 200:
@@ -81,12 +567,12 @@ class TogglApi:
         if raw_data is None or raw_data.response_data is None:
             url = "%s/projects.json" % self.base_url
             if self.verbose:
-                print(url)
-            r = requests.get(url, auth=self.auth)
+                self.log(url)
+            r = self._request('get', url)
             self._raise_if_error(r)
 
             if self.verbose:
-                print(r.text)
+                self.log(r.text)
             from_text = r.text
 
             if raw_data is not None:
@@ -96,7 +582,30 @@ class TogglApi:
             from_text = raw_data.response_data
 
         if (self.verbose):
-            print(from_text)
+            self.log(from_text)
+
+        return [TogglProject(p) for p in json.loads(from_text)['data']]
+
+    def get_workspace_projects(self, wsp_id, raw_data=None):
+        """Fetches the projects of one workspace as JSON objects."""
+
+        if raw_data is None or raw_data.response_data is None:
+            url = "%s/workspaces/%s/projects.json" % (self.base_url, wsp_id)
+            if self.verbose:
+                self.log(url)
+            r = self._request('get', url)
+            self._raise_if_error(r)
+
+            from_text = r.text
+
+            if raw_data is not None:
+                raw_data.request_url = url
+                raw_data.response_data = from_text
+        else:
+            from_text = raw_data.response_data
+
+        if self.verbose:
+            self.log(from_text)
 
         return [TogglProject(p) for p in json.loads(from_text)['data']]
 
@@ -107,14 +616,14 @@ class TogglApi:
         data = { KEY_PROJECT : proj.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
-        r = requests.post(url, auth=self.auth,
+            self.log(url)
+            self.log(data)
+        r = self._request('post', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
         
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -125,14 +634,14 @@ class TogglApi:
         data = { KEY_PROJECT : proj.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
-        r = requests.put(url, auth=self.auth,
+            self.log(url)
+            self.log(data)
+        r = self._request('put', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
         
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -143,14 +652,14 @@ class TogglApi:
         data = {KEY_ID : projlist}
 
         if self.verbose:
-            print(url)
-            print(data)
-        r = requests.put(url, auth=self.auth,
+            self.log(url)
+            self.log(data)
+        r = self._request('put', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
         
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -161,14 +670,14 @@ class TogglApi:
         data = {KEY_ID : projlist}
 
         if self.verbose:
-            print(url)
-            print(data)
-        r = requests.put(url, auth=self.auth,
+            self.log(url)
+            self.log(data)
+        r = self._request('put', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
         
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -183,15 +692,97 @@ class TogglApi:
             url = "%s?start_date=%s&end_date=%s" % \
                     (url, url_quote(str(end)), url_quote(str(start)))
         if self.verbose:
-            print(url)
-        r = requests.get(url, auth=self.auth)
+            self.log(url)
+        r = self._request('get', url)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
+
+        return [TogglEntry(e) for e in json.loads(r.text)['data']]
+
+    def poll_time_entries(self, start, end, validators):
+        """Like get_time_entries, but sends a conditional request using the
+           ETag and Last-Modified values in the validators dict. Returns None
+           if the server answers 304 Not Modified; otherwise stores the new
+           response's validators in the dict and returns the entries."""
+        url = "%s/time_entries.json?start_date=%s&end_date=%s" % \
+                (self.base_url, url_quote(str(end)), url_quote(str(start)))
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        if self.verbose:
+            self.log(url)
+        r = self._request('get', url, headers=headers)
+        if r.status_code == 304:
+            return None
+        self._raise_if_error(r)
 
+        validators.clear()
+        validators['etag'] = r.headers.get('ETag')
+        validators['last_modified'] = r.headers.get('Last-Modified')
         return [TogglEntry(e) for e in json.loads(r.text)['data']]
 
+    def stream_time_entries(self, start=None, end=None):
+        """Like get_time_entries, but reads the response incrementally and
+           yields the entries one at a time."""
+        for e in self.stream_time_entry_fields(start, end):
+            yield TogglEntry(e)
+
+    def stream_time_entry_fields(self, start=None, end=None):
+        """Like stream_time_entries, but yields the entries' JSON objects."""
+        url = "%s/time_entries.json" % self.base_url
+        if start is not None and end is not None:
+            url = "%s?start_date=%s&end_date=%s" % \
+                    (url, url_quote(str(end)), url_quote(str(start)))
+        if self.verbose:
+            self.log(url)
+        r = self._request('get', url, stream=True)
+        try:
+            self._raise_if_error(r)
+            for e in iter_json_array(r.iter_content(STREAM_CHUNK_SIZE)):
+                yield e
+        finally:
+            r.close()
+
+    def iter_time_entries(self, start, end, window=DEFAULT_WINDOW, reverse=False):
+        """Lazily yields the entries that start between start and end,
+           earliest first, or latest first if reverse is set. Unlike
+           get_time_entries, start is the earlier date. The range is fetched
+           one window at a time, and the next window is fetched in the
+           background while the caller works through the current one. A
+           caller that stops early has still had the window after the current
+           one requested, but none beyond it."""
+        bounds = []
+        cursor = start
+        while cursor < end:
+            upto = min(cursor + window, end)
+            bounds.append((cursor, upto))
+            cursor = upto
+        if reverse:
+            bounds.reverse()
+
+        def fetch(bound):
+            # get_time_entries takes the later date first.
+            entries = self.get_time_entries(bound[1], bound[0])
+            entries.sort(key=lambda e: e.start_time, reverse=reverse)
+            return entries
+
+        seen = set()
+        pending = TogglPrefetch(fetch, bounds[0]) if bounds else None
+        for i in range(len(bounds)):
+            entries = pending.result()
+            pending = TogglPrefetch(fetch, bounds[i + 1]) if i + 1 < len(bounds) else None
+            # Entries on a window boundary are returned by both windows.
+            ids = set()
+            for e in entries:
+                ids.add(e.id)
+                if e.id not in seen:
+                    yield e
+            seen = ids
+
     def get_time_entry(self, entry_id):
         """Find the entry with the specified id"""
         # Fetch the data or die trying.
@@ -200,14 +791,14 @@ class TogglApi:
         url = "%s/time_entries/%s.json" % \
             (self.base_url, url_quote(entry_id))
         if self.verbose:
-            print(url)
-        r = requests.get(url, auth=self.auth)
+            self.log(url)
+        r = self._request('get', url)
         if r.status_code == 404:
             return None 
         self._raise_if_error(r)
         
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglEntry(json.loads(r.text)['data'])
 
@@ -218,15 +809,15 @@ class TogglApi:
         data = { KEY_TIMEENTRY : entry.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
+            self.log(url)
+            self.log(data)
 
-        r = requests.post(url, auth=self.auth,
+        r = self._request('post', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
         
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -236,16 +827,16 @@ class TogglApi:
         data = { KEY_TIMEENTRY : entry.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
+            self.log(url)
+            self.log(data)
 
-        r = requests.put(url, auth=self.auth, data=json.dumps(data), headers=self.headers)
+        r = self._request('put', url, data=json.dumps(data), headers=self.headers)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -253,14 +844,14 @@ class TogglApi:
         """Delete the time entry with the specified id"""
         url = "%s/time_entries/%s.json" % (self.base_url, url_quote(entry_id))
         if self.verbose:
-            print(url)
-        r = requests.delete(url, auth=self.auth, data=None, headers=self.headers)
+            self.log(url)
+        r = self._request('delete', url, data=None, headers=self.headers)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -270,8 +861,8 @@ class TogglApi:
         if raw_data is None or raw_data.response_data is None:
             url = "%s/workspaces.json" % self.base_url
             if self.verbose:
-                print(url)
-            r = requests.get(url, auth=self.auth)
+                self.log(url)
+            r = self._request('get', url)
             self._raise_if_error(r)
             
             from_text = r.text
@@ -283,7 +874,7 @@ class TogglApi:
             from_text = raw_data.response_data
 
         if self.verbose:
-            print(from_text)
+            self.log(from_text)
 
         return [TogglWorkspace(w) for w in json.loads(from_text)['data']]
 
@@ -291,22 +882,71 @@ class TogglApi:
         """Get the user list for the specified workspace."""
         url = "%s/workspaces/%s/users.json" % (self.base_url, wsp_id)
         if self.verbose:
-            print(url)
-        r = requests.get(url, auth=self.auth)
+            self.log(url)
+        r = self._request('get', url)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return [TogglUser(u) for u in json.loads(r.text)['data']]
 
+    def iter_report_details(self, wsp_id, since, until, user_ids=None):
+        """Yields the detailed report rows of a workspace between the since
+           and until dates, optionally only for the given users, following
+           the report's pages. Unlike time entries, this covers every user
+           of the workspace."""
+        page = 1
+        while True:
+            url = "%s/details?workspace_id=%s&since=%s&until=%s&user_agent=%s&page=%d" % \
+                (self.reports_url, wsp_id, url_quote(str(since)),
+                 url_quote(str(until)), TOGGL_USER_AGENT, page)
+            if user_ids:
+                url = "%s&user_ids=%s" % (url, ','.join(str(u) for u in user_ids))
+            if self.verbose:
+                self.log(url)
+            r = self._request('get', url)
+            self._raise_if_error(r)
+
+            if self.verbose:
+                self.log(r.text)
+
+            report = json.loads(r.text)
+            for row in report['data']:
+                yield TogglReportEntry(row)
+            if not report['data'] or page * report.get('per_page', 50) >= report.get('total_count', 0):
+                return
+            page += 1
+
     def get_clients(self, raw_data=None):
         """Get list of clients."""
         if raw_data is None or raw_data.response_data is None:
             url = "%s/clients.json" % (self.base_url)
             if self.verbose:
-                print(url)
-            r = requests.get(url, auth=self.auth)
+                self.log(url)
+            r = self._request('get', url)
+            self._raise_if_error(r)
+
+            from_text = r.text
+
+            if raw_data is not None:
+                raw_data.request_url = url
+                raw_data.response_data = from_text
+        else:
+            from_text = raw_data.response_data
+
+        if self.verbose:
+            self.log(from_text)
+
+        return [TogglClient(c) for c in json.loads(from_text)['data']]
+
+    def get_workspace_clients(self, wsp_id, raw_data=None):
+        """Get the list of clients of one workspace."""
+        if raw_data is None or raw_data.response_data is None:
+            url = "%s/workspaces/%s/clients.json" % (self.base_url, wsp_id)
+            if self.verbose:
+                self.log(url)
+            r = self._request('get', url)
             self._raise_if_error(r)
 
             from_text = r.text
@@ -318,7 +958,7 @@ class TogglApi:
             from_text = raw_data.response_data
 
         if self.verbose:
-            print(from_text)
+            self.log(from_text)
 
         return [TogglClient(c) for c in json.loads(from_text)['data']]
 
@@ -328,15 +968,15 @@ class TogglApi:
         data = { KEY_CLIENT : cl.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
+            self.log(url)
+            self.log(data)
 
-        r = requests.post(url, auth=self.auth,
+        r = self._request('post', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -346,16 +986,16 @@ class TogglApi:
         data = { KEY_CLIENT : cl.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
+            self.log(url)
+            self.log(data)
 
-        r = requests.put(url, auth=self.auth, data=json.dumps(data), headers=self.headers)
+        r = self._request('put', url, data=json.dumps(data), headers=self.headers)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -363,14 +1003,14 @@ class TogglApi:
         """Delete the time entry with the specified id"""
         url = "%s/clients/%d.json" % (self.base_url, int(client_id))
         if self.verbose:
-            print(url)
-        r = requests.delete(url, auth=self.auth, data=None, headers=self.headers)
+            self.log(url)
+        r = self._request('delete', url, data=None, headers=self.headers)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -378,14 +1018,14 @@ class TogglApi:
         """Get the list of tasks"""
         url = "%s/tasks.json?active=%s" % (self.base_url, active)
         if self.verbose:
-            print(url)
-        r = requests.get(url, auth=self.auth)
+            self.log(url)
+        r = self._request('get', url)
         self._raise_if_error(r)
 
         from_text = r.text
 
         if self.verbose:
-            print(from_text)
+            self.log(from_text)
 
         return [TogglTask(t) for t in json.loads(from_text)['data']]
 
@@ -395,15 +1035,15 @@ class TogglApi:
         data = { KEY_TASK: task.to_json() }
 
         if self.verbose:
-            print(url)
-            print(data)
+            self.log(url)
+            self.log(data)
 
-        r = requests.post(url, auth=self.auth,
+        r = self._request('post', url,
             data=json.dumps(data), headers=self.headers)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -412,14 +1052,14 @@ class TogglApi:
         url = "%s/tasks/%d.json" % (self.base_url, int(task_id))
 
         if self.verbose:
-            print(url)
-        r = requests.delete(url, auth=self.auth, data=None, headers=self.headers)
+            self.log(url)
+        r = self._request('delete', url, data=None, headers=self.headers)
         if r.status_code == 404:
             return TogglResponse(False)
         self._raise_if_error(r)
 
         if self.verbose:
-            print(r.text)
+            self.log(r.text)
 
         return TogglResponse(True, json.loads(r.text))
 
@@ -687,6 +1327,48 @@ class TogglProject(TogglObject):
     def to_json(self):
         return self.fields
 
+class TogglReportEntry(object):
+    """A row of a detailed report. Durations are converted from the
+       report's milliseconds to seconds."""
+    def __init__(self, fields):
+        self.fields = fields
+
+    @property
+    def id(self):
+        return self.fields[KEY_ID]
+
+    @property
+    def user_id(self):
+        return self.fields.get('uid')
+
+    @property
+    def user(self):
+        return self.fields.get('user')
+
+    @property
+    def project(self):
+        return self.fields.get(KEY_PROJECT)
+
+    @property
+    def client(self):
+        return self.fields.get(KEY_CLIENT)
+
+    @property
+    def desc(self):
+        return self.fields.get(KEY_DESC)
+
+    @property
+    def start_time(self):
+        return self.fields[KEY_START]
+
+    @property
+    def stop_time(self):
+        return self.fields.get('end')
+
+    @property
+    def duration(self):
+        return int(self.fields.get('dur') or 0) // 1000
+
 class TogglEntry(object):
     def __init__(self, fields=None):
         if fields is not None:
@@ -30,31 +30,314 @@ from libtoggl import *
 
 import datetime
 import json
+import mmap
 import os
 import pytz
 import sys
+import threading
 import time
 import urllib
 import argparse
+import bisect
+import calendar
+import collections
+import csv
+import fnmatch
+import heapq
+import io
+import multiprocessing
 import re
+import shlex
+import sqlite3
+import struct
 import dateutil.parser as date_parser
+import requests
 
 try:
     import configparser
 except:
     import ConfigParser as configparser
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
 TOGGL_URL = "https://www.toggl.com/api"
 DEFAULT_DATEFMT = '%Y-%m-%d (%A)'
 DEFAULT_ENTRY_DATEFMT = '%Y-%m-%d %H:%M%p'
 DEFAULT_CACHE_PATH = '~/.toggl'
 alias_dict = {}
+# Project name -> alias, the reverse of alias_dict, for display.
+alias_rev_dict = {}
+
+CACHE_STATS_FILE = 'stats.json'
+STORE_FILE = 'entries.db'
+COMPLETION_DIR = 'completion'
+COMPLETION_RECENT_ENTRIES = 200
+CACHE_INDEX_MAGIC = b'TGLIDX1\0'
+# magic, record count, data file size, ordinal table, id table, name table
+CACHE_INDEX_HEADER = struct.Struct('<8sIQQQQ')
+# record offset and length in the data file, in collection order
+CACHE_INDEX_ORDINAL = struct.Struct('<QI')
+# id, ordinal; sorted by id
+CACHE_INDEX_ID = struct.Struct('<qI')
+# name offset and length in the index file, ordinal; sorted by name
+CACHE_INDEX_NAME = struct.Struct('<QII')
+
+class TogglCacheIndex:
+    """Memory-mapped view of a collection written by
+       TogglCache.write_records(). Lookups binary search the fixed-layout
+       tables in the .idx file and decode only the matching record from the
+       data file, so only the pages they touch are read."""
+
+    def __init__(self, data_path, index_path):
+        self._data_file = open(data_path, "rb")
+        self._index_file = open(index_path, "rb")
+        try:
+            self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self._count, data_size, self._ordinals, self._ids, self._names = \
+                CACHE_INDEX_HEADER.unpack_from(self._index, 0)
+        except (ValueError, struct.error, mmap.error):
+            self.close()
+            raise ValueError("Corrupt cache index %s" % index_path)
+        if magic != CACHE_INDEX_MAGIC or data_size != len(self._data):
+            self.close()
+            raise ValueError("Stale cache index %s" % index_path)
+        self.bytes_read = 0
+
+    def close(self):
+        for name in ('_data', '_index'):
+            if hasattr(self, name):
+                getattr(self, name).close()
+        self._data_file.close()
+        self._index_file.close()
+
+    def __len__(self):
+        return self._count
+
+    def record(self, ordinal):
+        """Decodes the record at the given position in the collection."""
+        offset, length = CACHE_INDEX_ORDINAL.unpack_from(self._index,
+                self._ordinals + ordinal * CACHE_INDEX_ORDINAL.size)
+        self.bytes_read += length
+        return json.loads(self._data[offset:offset + length].decode('utf-8'))
+
+    def _id_at(self, pos):
+        return CACHE_INDEX_ID.unpack_from(self._index, self._ids + pos * CACHE_INDEX_ID.size)
+
+    def _name_at(self, pos):
+        offset, length, ordinal = CACHE_INDEX_NAME.unpack_from(self._index,
+                self._names + pos * CACHE_INDEX_NAME.size)
+        return self._index[offset:offset + length], ordinal
+
+    def find_id(self, obj_id):
+        """Returns the ordinal of the record with the given id, or None."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_at(mid)[0] < obj_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._id_at(lo)[0] == obj_id:
+            return self._id_at(lo)[1]
+        return None
+
+    def find_prefix(self, prefix, exact=False):
+        """Returns the lowest ordinal whose name starts with prefix, or is
+           equal to it if exact is set, or None."""
+        key = prefix.encode('utf-8')
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_at(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = None
+        while lo < self._count:
+            name, ordinal = self._name_at(lo)
+            if not name.startswith(key):
+                break
+            if exact and name != key:
+                break
+            if found is None or ordinal < found:
+                found = ordinal
+            lo += 1
+        return found
+
+    def find_name(self, name):
+        """Returns the first record named exactly name, or None."""
+        found = self.find_prefix(name, exact=True)
+        return self.record(found) if found is not None else None
+
+    def find(self, key):
+        """Finds the first record, in collection order, whose id equals key
+           or whose name starts with it, like a linear scan would."""
+        candidates = []
+        try:
+            candidates.append(self.find_id(int(key)))
+        except ValueError:
+            pass
+        candidates.append(self.find_prefix(key))
+        candidates = [c for c in candidates if c is not None]
+        if not candidates:
+            return None
+        return self.record(min(candidates))
+
+FUZZY_COLLECTIONS = ['projects', 'clients', 'workspaces']
+# Client and workspace names count for a little less than the project's own.
+FUZZY_RELATED_WEIGHT = 0.8
+FUZZY_MIN_SCORE = 0.4
+
+def word_trigrams(text):
+    """Returns the trigrams of each word of text, padded so that word starts
+       weigh more and one or two letter words still have grams."""
+    grams = set()
+    for word in text.lower().split():
+        word = "  %s " % word
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+def is_subsequence(needle, haystack):
+    it = iter(haystack)
+    return all(c in it for c in needle)
+
+class TogglFuzzyIndex:
+    """Ranks projects against a loosely typed query using the trigram tables
+       written next to the project, client and workspace caches. A query
+       word matches a project through the project's name or, for a little
+       less, through its client's or workspace's name."""
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    @staticmethod
+    def build_table(items):
+        """Builds the trigram table of a collection: the id, name,
+           workspace id and client id of each record, and the ordinals of
+           the records containing each trigram."""
+        table = {'ids': [], 'names': [], 'wids': [], 'cids': [], 'grams': {}}
+        for ordinal, item in enumerate(items):
+            name = item.get(KEY_NAME) or ''
+            table['ids'].append(item.get(KEY_ID))
+            table['names'].append(name)
+            table['wids'].append(workspace_of(item))
+            table['cids'].append(client_of(item))
+            for gram in word_trigrams(name):
+                table['grams'].setdefault(gram, []).append(ordinal)
+        return table
+
+    @staticmethod
+    def merge(tables):
+        """Merges the tables of several shards into one."""
+        merged = TogglFuzzyIndex.build_table([])
+        for table in tables:
+            base = len(merged['ids'])
+            for key in ('ids', 'names', 'wids', 'cids'):
+                merged[key].extend(table[key])
+            for gram, ordinals in table['grams'].items():
+                merged['grams'].setdefault(gram, []).extend(o + base for o in ordinals)
+        return merged
+
+    def _term_scores(self, table, term, grams):
+        """Scores every record sharing a trigram with term: the share of the
+           term's trigrams found in the name, raised for substrings and
+           subsequences. Returns a dict of ordinal -> score."""
+        counts = collections.defaultdict(int)
+        for gram in grams:
+            for ordinal in table['grams'].get(gram, ()):
+                counts[ordinal] += 1
+        scores = {}
+        for ordinal, count in counts.items():
+            name = table['names'][ordinal].lower()
+            if name.startswith(term) or (" " + term) in name:
+                score = 1.0
+            elif term in name:
+                score = 0.9
+            else:
+                score = float(count) / len(grams)
+                if is_subsequence(term, name):
+                    score = max(score, 0.6)
+            scores[ordinal] = score
+        return scores
+
+    def _related_scores(self, collection, terms):
+        """Returns a dict of id -> [score per term] for a client or workspace
+           table."""
+        table = self.tables.get(collection)
+        related = {}
+        if table is None:
+            return related
+        for i, (term, grams) in enumerate(terms):
+            for ordinal, score in self._term_scores(table, term, grams).items():
+                obj_id = table['ids'][ordinal]
+                scores = related.setdefault(obj_id, [0.0] * len(terms))
+                scores[i] = max(scores[i], score * FUZZY_RELATED_WEIGHT)
+        return related
+
+    def search(self, query, limit=10):
+        """Returns up to limit (score, project id, project name) tuples, best
+           first, with scores from 0 to 1."""
+        projects = self.tables.get('projects')
+        terms = [(t, word_trigrams(t)) for t in query.lower().split()]
+        if projects is None or not terms:
+            return []
+        clients = self._related_scores('clients', terms)
+        workspaces = self._related_scores('workspaces', terms)
+        own = [self._term_scores(projects, term, grams) for term, grams in terms]
+
+        candidates = set()
+        for scores in own:
+            candidates.update(scores)
+        for ordinal in range(len(projects['ids'])):
+            if projects['cids'][ordinal] in clients or projects['wids'][ordinal] in workspaces:
+                candidates.add(ordinal)
+
+        results = []
+        nothing = [0.0] * len(terms)
+        for ordinal in candidates:
+            cscores = clients.get(projects['cids'][ordinal], nothing)
+            wscores = workspaces.get(projects['wids'][ordinal], nothing)
+            total = sum(max(own[i].get(ordinal, 0.0), cscores[i], wscores[i])
+                    for i in range(len(terms)))
+            score = total / len(terms)
+            if score >= FUZZY_MIN_SCORE:
+                results.append((score, projects['ids'][ordinal], projects['names'][ordinal]))
+        results.sort(key=lambda r: (-r[0], r[2]))
+        return results[:limit]
+
+# The cached collections. Only their files, in the cache directory and its
+# workspace shards, are ever evicted.
+CACHE_COLLECTIONS = ['workspaces', 'projects', 'clients']
+CACHE_STAT_KEYS = ['hits', 'misses', 'expirations', 'evictions',
+    'bytes_read', 'bytes_written', 'loads', 'load_time']
 
 class TogglCache:
-    def __init__(self, cache_path, cache_enabled, max_age_days=0):
+    def __init__(self, cache_path, cache_enabled, max_age_days=0,
+            collection_ages=None, max_size_kb=0, sharded=False):
         self._cache_path = os.path.expanduser(cache_path)
         self._enabled = cache_enabled
         self._max_age_days = max_age_days
+        self._collection_ages = collection_ages or {}
+        self._max_size = int(max_size_kb * 1024)
+        self._sharded = sharded
+        self._stats = None
+        self._stats_added = {}
+        self._lock = threading.Lock()
+        self._eviction_holds = 0
 
         if not os.path.exists(self._cache_path):
             os.makedirs(self._cache_path)
@@ -63,22 +346,145 @@ class TogglCache:
     def enabled(self):
         return self._enabled
 
-    def cache_age_expired(self, cachemodtime):
-        return (time.time() - cachemodtime) / (60 * 60 * 24) > self._max_age_days
+    @property
+    def path(self):
+        return self._cache_path
+
+    @property
+    def sharded(self):
+        """Whether projects and clients are cached per workspace."""
+        return self._enabled and self._sharded
+
+    def _read_stats(self):
+        data = None
+        try:
+            f = open(self._collection_file(CACHE_STATS_FILE), "r")
+            data = f.read()
+            f.close()
+        except IOError:
+            pass
+        try:
+            return json.loads(data) if data else {}
+        except ValueError:
+            return {}
+
+    @property
+    def stats(self):
+        """Per-collection counters, persisted across runs in stats.json."""
+        if self._stats is None:
+            self._stats = self._read_stats()
+        return self._stats
+
+    def record(self, collection, key, amount=1):
+        with self._lock:
+            counters = self.stats.setdefault(collection, {})
+            counters[key] = counters.get(key, 0) + amount
+            added = self._stats_added.setdefault(collection, {})
+            added[key] = added.get(key, 0) + amount
+
+    def record_load(self, collection, seconds):
+        """Records the time spent parsing a cached collection into objects."""
+        self.record(collection, 'loads')
+        self.record(collection, 'load_time', seconds)
+
+    def save_stats(self):
+        """Adds the counts recorded by this run to those in stats.json and
+           rewrites it atomically. Concurrent runs, such as export workers,
+           take turns where file locks are available."""
+        if self._stats_added:
+            self._rewrite_stats(reset=False)
+
+    def reset_stats(self):
+        self._rewrite_stats(reset=True)
+
+    def _rewrite_stats(self, reset):
+        path = self._collection_file(CACHE_STATS_FILE)
+        try:
+            lock = open(path + ".lock", "a")
+        except IOError:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = {} if reset else self._read_stats()
+            with self._lock:
+                if not reset:
+                    for collection, added in self._stats_added.items():
+                        counters = stats.setdefault(collection, {})
+                        for key, amount in added.items():
+                            counters[key] = counters.get(key, 0) + amount
+                self._stats_added = {}
+            f = open(path + ".tmp", "w")
+            f.write(json.dumps(stats, sort_keys=True))
+            f.close()
+            os.rename(path + ".tmp", path)
+            self._stats = stats
+        except (IOError, OSError):
+            pass
+        finally:
+            lock.close()
+
+    def _collection_file(self, name, workspace=None):
+        if workspace is None:
+            return "%s/%s" % (self._cache_path, name)
+        return "%s/shards/%s/%s" % (self._cache_path, workspace, name)
+
+    def shard_ids(self, collection):
+        """Returns the ids of the workspaces with a cached shard of the
+           collection, in numeric order."""
+        try:
+            names = os.listdir("%s/shards" % self._cache_path)
+        except OSError:
+            return []
+        ids = [n for n in names if os.path.exists(self._collection_file("%s.cache" % collection, n))]
+        return sorted(ids, key=lambda n: int(n) if n.isdigit() else n)
+
+    def _collection_name(self, path):
+        name = os.path.basename(path)
+        if name.endswith('.cache'):
+            name = name[:-len('.cache')]
+        return name
+
+    def max_age_days(self, collection):
+        """Returns the TTL for the collection, or the global one if unset."""
+        return self._collection_ages.get(collection, self._max_age_days)
+
+    def cache_age_expired(self, cachemodtime, max_age_days=None):
+        if max_age_days is None:
+            max_age_days = self._max_age_days
+        return (time.time() - cachemodtime) / (60 * 60 * 24) > max_age_days
+
+    def touch(self, path):
+        """Marks the file as recently used by bumping its access time only,
+           so the LRU order survives noatime mounts and the age is kept."""
+        try:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except OSError:
+            pass
 
     def read_cache_file(self, path):
+        collection = self._collection_name(path)
+        max_age = self.max_age_days(collection)
         try:
-            if self._max_age_days > 0 and self.cache_age_expired(os.path.getmtime(path)):
+            if max_age > 0 and self.cache_age_expired(os.path.getmtime(path), max_age):
                 print("Cache is expired.")
+                self.record(collection, 'expirations')
                 return None
             f = open(path, "r")
             data = f.read()
             f.close()
             if data == "":
                 data = None 
-        except IOError:
+            else:
+                self.touch(path)
+        except (IOError, OSError):
             data = None
 
+        if data is None:
+            self.record(collection, 'misses')
+        else:
+            self.record(collection, 'hits')
+            self.record(collection, 'bytes_read', len(data))
         return data
 
     def write_cache_file(self, path, data):
@@ -86,27 +492,738 @@ class TogglCache:
             f = open(path, "w")
             f.write(data)
             f.close()
+            self.record(self._collection_name(path), 'bytes_written', len(data))
+        except IOError:
+            print("Failed to update %s" % path)
+            pass
+        self.enforce_size_limit(keep=path)
+
+    def cache_groups(self):
+        """Groups the files of the CACHE_COLLECTIONS by path without
+           extension, so a collection and its side files are evicted
+           together. Returns a dict of group -> (last access time, total
+           bytes, [paths])."""
+        dirs = [self._cache_path]
+        try:
+            shards = "%s/shards" % self._cache_path
+            dirs.extend(os.path.join(shards, n) for n in os.listdir(shards))
+        except OSError:
+            pass
+        groups = {}
+        for root in dirs:
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            for name in names:
+                if os.path.splitext(name)[0] not in CACHE_COLLECTIONS:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                group = os.path.splitext(path)[0]
+                atime, size, paths = groups.get(group, (0, 0, []))
+                paths.append(path)
+                groups[group] = (max(atime, st.st_atime), size + st.st_size, paths)
+        return groups
+
+    def hold_eviction(self):
+        """Defers enforce_size_limit until the matching release_eviction,
+           so that shards written by concurrent loads are not evicted by one
+           another."""
+        with self._lock:
+            self._eviction_holds += 1
+
+    def release_eviction(self):
+        with self._lock:
+            self._eviction_holds -= 1
+            holds = self._eviction_holds
+        if holds == 0:
+            self.enforce_size_limit()
+
+    def enforce_size_limit(self, keep=None):
+        """Evicts the least recently used cache files until the cache fits
+           in the configured size budget. The group containing keep, usually
+           the file just written, is never evicted."""
+        if self._max_size <= 0 or self._eviction_holds:
+            return
+        groups = self.cache_groups()
+        total = sum(size for atime, size, paths in groups.values())
+        keep_group = os.path.splitext(keep)[0] if keep else None
+        for group in sorted(groups.keys(), key=lambda g: groups[g][0]):
+            if total <= self._max_size:
+                break
+            if group == keep_group:
+                continue
+            atime, size, paths = groups[group]
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+            self.record(self._collection_name(group + '.cache'), 'evictions')
+
+    def index_path(self, path):
+        return os.path.splitext(path)[0] + '.idx'
+
+    def fuzzy_path(self, path):
+        return os.path.splitext(path)[0] + '.tri'
+
+    def write_fuzzy_table(self, path, items):
+        """Writes the trigram table TogglFuzzyIndex reads for a project,
+           client or workspace cache file."""
+        if self._collection_name(path) not in FUZZY_COLLECTIONS:
+            return
+        try:
+            f = open(self.fuzzy_path(path), "w")
+            json.dump(TogglFuzzyIndex.build_table(items), f, separators=(',', ':'))
+            f.close()
+        except IOError:
+            pass
+
+    def read_fuzzy_tables(self, collection):
+        """Returns the merged trigram table of a collection, or of all of its
+           shards when the cache is sharded, or None if any cached file lacks
+           one. A collection file left from before sharding is ignored."""
+        if self.sharded and collection in SHARDED_COLLECTIONS:
+            paths = [self._collection_file("%s.cache" % collection, wsp)
+                    for wsp in self.shard_ids(collection)]
+        else:
+            paths = [self._collection_file("%s.cache" % collection)]
+        tables = []
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                f = open(self.fuzzy_path(path), "r")
+                tables.append(json.load(f))
+                f.close()
+            except (IOError, ValueError):
+                return None
+        if not tables:
+            return None
+        return TogglFuzzyIndex.merge(tables)
+
+    def write_records(self, path, items):
+        """Writes the collection as a '{"data": [...]}' response with one
+           record per line, plus an .idx file with the offset of each record
+           and id/name lookup tables for TogglCacheIndex."""
+        parts = [b'{"data": [\n']
+        offset = len(parts[0])
+        ordinals = []
+        ids = []
+        names = []
+        for ordinal, item in enumerate(items):
+            rec = json.dumps(item).encode('utf-8')
+            if ordinal > 0:
+                parts.append(b',\n')
+                offset += 2
+            parts.append(rec)
+            ordinals.append((offset, len(rec)))
+            offset += len(rec)
+            try:
+                ids.append((int(item[KEY_ID]), ordinal))
+            except (KeyError, TypeError, ValueError):
+                pass
+            names.append(((item.get(KEY_NAME) or '').encode('utf-8'), ordinal))
+        parts.append(b'\n]}')
+        data = b''.join(parts)
+
+        ids.sort()
+        names.sort()
+        ordinal_off = CACHE_INDEX_HEADER.size
+        id_off = ordinal_off + len(ordinals) * CACHE_INDEX_ORDINAL.size
+        name_off = id_off + len(ids) * CACHE_INDEX_ID.size
+        string_off = name_off + len(names) * CACHE_INDEX_NAME.size
+        index = [CACHE_INDEX_HEADER.pack(CACHE_INDEX_MAGIC, len(ordinals),
+            len(data), ordinal_off, id_off, name_off)]
+        index.extend(CACHE_INDEX_ORDINAL.pack(o, l) for o, l in ordinals)
+        # Records without an integer id are still reachable by name.
+        index.extend(CACHE_INDEX_ID.pack(i, o) for i, o in ids)
+        for name, ordinal in names:
+            index.append(CACHE_INDEX_NAME.pack(string_off, len(name), ordinal))
+            string_off += len(name)
+        index.extend(name for name, ordinal in names)
+
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Write the index last so a reader never sees a new index over an
+            # old data file; the size check in TogglCacheIndex catches the rest.
+            f = open(path, "wb")
+            f.write(data)
+            f.close()
+            f = open(self.index_path(path), "wb")
+            f.write(b''.join(index))
+            f.close()
+            self.record(self._collection_name(path), 'bytes_written', len(data))
         except IOError:
             print("Failed to update %s" % path)
+        self.write_fuzzy_table(path, items)
+        self.write_completion(path, items)
+        self.enforce_size_limit(keep=path)
+
+    def completion_file(self, kind, name):
+        return "%s/%s/%s/%s" % (self._cache_path, COMPLETION_DIR, kind, name)
+
+    def write_completion_list(self, kind, name, values):
+        """Writes one completion list: one value per line, read directly by
+           the shell completion scripts."""
+        path = self.completion_file(kind, name)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            f = io.open(path, "w", encoding="utf-8")
+            f.write(u''.join(u"%s\n" % v for v in values))
+            f.close()
+        except (IOError, OSError):
             pass
 
+    def write_completion(self, path, items):
+        """Rebuilds the name and id completion lists of a cached collection
+           or shard; shards get their own lists, e.g. names/projects.42."""
+        rel = os.path.relpath(os.path.splitext(path)[0], self._cache_path).split(os.sep)
+        name = rel[-1] if len(rel) == 1 else "%s.%s" % (rel[-1], rel[-2])
+        self.write_completion_list("names", name,
+                [item[KEY_NAME] for item in items if item.get(KEY_NAME)])
+        self.write_completion_list("ids", name,
+                [item[KEY_ID] for item in items if item.get(KEY_ID) is not None])
+
+    def open_index(self, collection, workspace=None):
+        """Returns a TogglCacheIndex for the collection, or None if it is
+           not cached, expired or has no usable index."""
+        path = self._collection_file("%s.cache" % collection, workspace)
+        max_age = self.max_age_days(collection)
+        try:
+            # Expired caches are reported by the full read callers fall back to.
+            if max_age > 0 and self.cache_age_expired(os.path.getmtime(path), max_age):
+                return None
+            index = TogglCacheIndex(path, self.index_path(path))
+        except (IOError, OSError, ValueError):
+            return None
+        self.touch(path)
+        self.record(collection, 'hits')
+        return index
+
+    def merge_cache_file(self, path, objs, removed_ids=()):
+        """Merges the given JSON objects into the cached collection at path,
+           replacing any cached object with the same id, and drops the
+           objects listed in removed_ids. Missing caches are left alone so
+           the next read still goes to the server."""
+        try:
+            f = open(path, "r")
+            data = f.read()
+            f.close()
+            mtime = os.path.getmtime(path)
+        except (IOError, OSError):
+            return False
+        if data == "":
+            return False
+
+        cached = json.loads(data)
+        removed = set(str(i) for i in removed_ids)
+        positions = {}
+        items = []
+        for item in cached['data']:
+            if str(item[KEY_ID]) in removed:
+                continue
+            positions[str(item[KEY_ID])] = len(items)
+            items.append(item)
+        for obj in objs:
+            key = str(obj[KEY_ID])
+            if key in removed:
+                continue
+            if key in positions:
+                items[positions[key]] = obj
+            else:
+                positions[key] = len(items)
+                items.append(obj)
+
+        self.write_records(path, items)
+        # Keep the original age; the rest of the collection is no fresher.
+        try:
+            os.utime(path, (mtime, mtime))
+        except OSError:
+            pass
+        return True
+
+    def read_collection(self, collection, workspace=None):
+        return self.read_cache_file(self._collection_file("%s.cache" % collection, workspace))
+
+    def update_collection(self, collection, data, workspace=None):
+        return self.write_records(self._collection_file("%s.cache" % collection, workspace),
+                json.loads(data)['data'])
+
+    def merge_collection(self, collection, objs, removed_ids=(), workspace=None):
+        return self.merge_cache_file(self._collection_file("%s.cache" % collection, workspace),
+                objs, removed_ids)
+
+    def open_store(self, timezone=None):
+        if timezone is None:
+            timezone = toggl_cfg.get('options', 'timezone')
+        return TogglEntryStore(self._collection_file(STORE_FILE), timezone)
+
+    def has_store(self):
+        return self._enabled and os.path.exists(self._collection_file(STORE_FILE))
+
     def read_project_cache(self):
-        return self.read_cache_file("%s/%s" % (self._cache_path, "projects.cache"))
+        return self.read_collection("projects")
 
     def update_project_cache(self, data):
-        return self.write_cache_file("%s/%s" % (self._cache_path, "projects.cache"), data)
+        return self.update_collection("projects", data)
 
     def read_workspace_cache(self):
-        return self.read_cache_file("%s/%s" % (self._cache_path, "workspaces.cache"))
+        return self.read_collection("workspaces")
 
     def update_workspace_cache(self, data):
-        return self.write_cache_file("%s/%s" % (self._cache_path, "workspaces.cache"), data)
+        return self.update_collection("workspaces", data)
 
     def read_client_cache(self):
-        return self.read_cache_file("%s/%s" % (self._cache_path, "clients.cache"))
+        return self.read_collection("clients")
 
     def update_client_cache(self, data):
-        return self.write_cache_file("%s/%s" % (self._cache_path, "clients.cache"), data)
+        return self.update_collection("clients", data)
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    start_ts REAL NOT NULL,
+    stop_ts REAL,
+    duration INTEGER,
+    description TEXT,
+    project_id INTEGER,
+    workspace_id INTEGER,
+    billable INTEGER,
+    fields TEXT NOT NULL,
+    day TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_start ON entries (start_ts);
+CREATE TABLE IF NOT EXISTS store_info (timezone TEXT);
+"""
+
+# Per-project, per-day duration rollups, kept current by triggers on every
+# insert, replace and delete of an entry. The day is the local one of the
+# entry's start, worked out in the configured timezone when it is stored.
+# Running entries count once they are stopped. Entries without a project are
+# rolled up under id 0.
+STORE_ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS project_days (
+    project_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    seconds INTEGER NOT NULL,
+    entries INTEGER NOT NULL,
+    PRIMARY KEY (project_id, day)
+);
+CREATE TRIGGER IF NOT EXISTS entries_rollup_add AFTER INSERT ON entries BEGIN
+    -- No conflict clause here: the firing statement's OR REPLACE would
+    -- override it and reset the row.
+    INSERT INTO project_days
+        SELECT COALESCE(NEW.project_id, 0), NEW.day, 0, 0
+        WHERE NOT EXISTS (SELECT 1 FROM project_days
+            WHERE project_id = COALESCE(NEW.project_id, 0) AND day = NEW.day);
+    UPDATE project_days SET seconds = seconds + MAX(NEW.duration, 0), entries = entries + 1
+        WHERE project_id = COALESCE(NEW.project_id, 0) AND day = NEW.day;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_rollup_remove AFTER DELETE ON entries BEGIN
+    UPDATE project_days SET seconds = seconds - MAX(OLD.duration, 0), entries = entries - 1
+        WHERE project_id = COALESCE(OLD.project_id, 0) AND day = OLD.day;
+    DELETE FROM project_days WHERE entries <= 0;
+END;
+"""
+# Version 1 rolled up by UTC day, before entries had a day column.
+STORE_UTC_ROLLUPS_SCHEMA = """
+DROP TRIGGER IF EXISTS entries_rollup_add;
+DROP TRIGGER IF EXISTS entries_rollup_remove;
+DROP TABLE IF EXISTS project_days;
+ALTER TABLE entries ADD COLUMN day TEXT;
+"""
+STORE_VERSION = 2
+STORE_DAY_FMT = "%Y-%m-%d"
+
+def to_timestamp(timestr):
+    """Converts an API timestamp to seconds since the epoch."""
+    return calendar.timegm(parse_iso_time(timestr).utctimetuple())
+
+def entry_project_id(fields):
+    proj = fields.get(KEY_PROJECT)
+    if isinstance(proj, dict):
+        return proj.get(KEY_ID)
+    return fields.get('pid')
+
+class TogglEntryStore:
+    """Local copy of time entries in an SQLite database next to the caches,
+       filled by 'toggl sync'. Each row keeps the entry's full JSON to rebuild
+       TogglEntry objects, plus the columns that queries filter on."""
+
+    def __init__(self, path, timezone):
+        self._tz = pytz.timezone(timezone)
+        self._db = sqlite3.connect(path)
+        # Lets ls filters push desc~REGEX down into the WHERE clause.
+        self._db.create_function("REGEXP", 2,
+                lambda pattern, value: value is not None and re.search(pattern, value) is not None)
+        # REPLACE only fires the delete trigger with recursive triggers on.
+        self._db.execute("PRAGMA recursive_triggers = ON")
+        self._db.executescript(STORE_SCHEMA)
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version < STORE_VERSION:
+            if version == 1:
+                self._db.executescript(STORE_UTC_ROLLUPS_SCHEMA)
+            self._db.executescript(STORE_ROLLUP_SCHEMA +
+                    "PRAGMA user_version = %d;" % STORE_VERSION)
+        row = self._db.execute("SELECT timezone FROM store_info").fetchone()
+        if row is None or row[0] != timezone:
+            self._rebuild_days(timezone)
+
+    def _rebuild_days(self, timezone):
+        """Works out the local day of every stored entry again, as when the
+           configured timezone changed, and rebuilds the rollups from them."""
+        days = [(self._day(row[1]), row[0])
+                for row in self._db.execute("SELECT id, start_ts FROM entries")]
+        # Updates leave the rollup triggers alone.
+        self._db.executemany("UPDATE entries SET day = ? WHERE id = ?", days)
+        self._db.execute("DELETE FROM project_days")
+        self._db.execute("INSERT INTO project_days "
+                "SELECT COALESCE(project_id, 0), day, SUM(MAX(duration, 0)), COUNT(*) "
+                "FROM entries GROUP BY 1, 2")
+        self._db.execute("DELETE FROM store_info")
+        self._db.execute("INSERT INTO store_info VALUES (?)", (timezone,))
+        self._db.commit()
+
+    def _day(self, ts):
+        return datetime.datetime.fromtimestamp(ts, self._tz).strftime(STORE_DAY_FMT)
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _row(self, entry):
+        fields = entry.fields
+        stop = fields.get(KEY_STOP)
+        start = to_timestamp(entry.start_time)
+        return (entry.id, start, to_timestamp(stop) if stop else None,
+                entry.duration, fields.get(KEY_DESC), entry_project_id(fields),
+                workspace_of(fields), 1 if fields.get(KEY_BILLABLE) else 0,
+                json.dumps(fields), self._day(start))
+
+    def upsert(self, entries):
+        self._db.executemany("INSERT OR REPLACE INTO entries (id, start_ts, stop_ts, duration, "
+                "description, project_id, workspace_id, billable, fields, day) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._row(e) for e in entries])
+        self._db.commit()
+
+    def delete(self, ids):
+        self._db.executemany("DELETE FROM entries WHERE id = ?", [(int(i),) for i in ids])
+        self._db.commit()
+
+    def ids_between(self, start_ts, end_ts):
+        return set(row[0] for row in self._db.execute(
+            "SELECT id FROM entries WHERE start_ts >= ? AND start_ts < ?", (start_ts, end_ts)))
+
+    def project_totals(self):
+        """Returns project id -> (seconds, entries) over all stored days."""
+        return dict((row[0], (row[1], row[2])) for row in self._db.execute(
+            "SELECT project_id, SUM(seconds), SUM(entries) FROM project_days GROUP BY project_id"))
+
+    def project_days(self, project_id):
+        """Returns the (day, seconds, entries) rollups of a project."""
+        return self._db.execute("SELECT day, seconds, entries FROM project_days "
+                "WHERE project_id = ? ORDER BY day", (int(project_id),)).fetchall()
+
+    def iter_entries(self, start_ts=None, end_ts=None, where=(), params=()):
+        """Yields the stored entries that start in [start_ts, end_ts) and
+           satisfy the extra where clauses, in start order, decoding them one
+           row at a time."""
+        for fields in self.iter_entry_fields(start_ts, end_ts, where, params):
+            yield TogglEntry(fields)
+
+    def iter_entry_fields(self, start_ts=None, end_ts=None, where=(), params=()):
+        """Like iter_entries, but yields the entries' JSON objects."""
+        sql = "SELECT fields FROM entries WHERE %s ORDER BY start_ts" % \
+                " AND ".join(["start_ts >= ?", "start_ts < ?"] + list(where))
+        bounds = (start_ts if start_ts is not None else float('-inf'),
+                end_ts if end_ts is not None else float('inf'))
+        for row in self._db.execute(sql, bounds + tuple(params)):
+            yield json.loads(row[0])
+
+class TogglIntervalIndex:
+    """Index over the time intervals of a set of entries. Entries are sorted
+       by start, and an implicit segment tree keeps the latest stop of each
+       run, so point queries skip every run that ended earlier. Running
+       entries are treated as stopping at now."""
+
+    def __init__(self, entries, now=None):
+        if now is None:
+            now = time.time()
+        intervals = []
+        for entry in entries:
+            start = to_timestamp(entry.start_time)
+            if entry.stop_time:
+                stop = to_timestamp(entry.stop_time)
+            elif int(entry.duration) < 0:
+                stop = now
+            else:
+                stop = start + int(entry.duration)
+            intervals.append((start, stop, entry))
+        intervals.sort(key=lambda i: (i[0], i[1]))
+        self.intervals = intervals
+        self._starts = [i[0] for i in intervals]
+
+        self._size = 1
+        while self._size < len(intervals):
+            self._size *= 2
+        tree = [float('-inf')] * (2 * self._size)
+        for n, interval in enumerate(intervals):
+            tree[self._size + n] = interval[1]
+        for node in range(self._size - 1, 0, -1):
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+        self._max_stop = tree
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def at(self, ts):
+        """Returns the entries running at ts: start <= ts < stop."""
+        found = []
+        count = bisect.bisect_right(self._starts, ts)
+        stack = [(1, 0, self._size)]
+        while stack:
+            node, lo, hi = stack.pop()
+            if lo >= count or self._max_stop[node] <= ts:
+                continue
+            if hi - lo == 1:
+                found.append(self.intervals[lo][2])
+                continue
+            mid = (lo + hi) // 2
+            stack.append((2 * node + 1, mid, hi))
+            stack.append((2 * node, lo, mid))
+        return found
+
+    def overlaps(self):
+        """Yields (entry, other, start, stop) for every pair of entries whose
+           intervals overlap, with the overlapping range, using a sweep over
+           the entries in start order."""
+        active = []
+        for n, (start, stop, entry) in enumerate(self.intervals):
+            while active and active[0][0] <= start:
+                heapq.heappop(active)
+            for other_stop, other in active:
+                yield (self.intervals[other][2], entry, start, min(stop, other_stop))
+            if stop > start:
+                heapq.heappush(active, (stop, n))
+
+def response_objects(resp):
+    """Returns the JSON objects carried by a mutation response as a list."""
+    if resp is None or not resp.success or resp.data is None:
+        return []
+    if isinstance(resp.data, list):
+        return resp.data
+    return [resp.data]
+
+def load_collection(collection, fetch, update_cache=False, workspace=None):
+    """Returns the objects of a cached collection, falling back to fetch()
+       on a cache miss and refreshing the cache when update_cache is set.
+       With a workspace, only that workspace's shard is read and written."""
+    raw = None
+    if toggl_cache.enabled:
+        raw = TogglRawData()
+        if not update_cache:
+            raw.response_data = toggl_cache.read_collection(collection, workspace)
+
+    from_cache = raw is not None and raw.response_data is not None
+    started = time.time()
+    objs = fetch(raw_data=raw)
+    if from_cache:
+        toggl_cache.record_load(collection, time.time() - started)
+
+    if update_cache and raw is not None:
+        toggl_cache.update_collection(collection, raw.response_data, workspace)
+
+    return objs
+
+# Per-workspace fetchers of the collections that are sharded by workspace.
+SHARDED_COLLECTIONS = {
+    'projects': ('get_workspace_projects', TogglProject),
+    'clients': ('get_workspace_clients', TogglClient),
+}
+
+def load_shards(collection, workspaces, update_cache=False):
+    """Loads the given workspaces' shards of a collection, fetching the
+       missing ones from the server concurrently."""
+    fetch = getattr(toggl, SHARDED_COLLECTIONS[collection][0])
+
+    def load_shard(wsp):
+        return load_collection(collection,
+                lambda raw_data=None: fetch(wsp.id, raw_data=raw_data),
+                update_cache, workspace=wsp.id)
+
+    toggl_cache.hold_eviction()
+    try:
+        shards = parallel_map(load_shard, workspaces)
+    finally:
+        toggl_cache.release_eviction()
+    return [obj for objs in shards for obj in objs]
+
+def load_all(collection, fetch, update_cache=False):
+    """Loads a whole collection, from its workspace shards if sharded."""
+    if toggl_cache.sharded and collection in SHARDED_COLLECTIONS:
+        return load_shards(collection,
+                load_collection("workspaces", toggl.get_workspaces), update_cache)
+    return load_collection(collection, fetch, update_cache)
+
+def workspace_of(obj):
+    """Returns the workspace id of a project or client JSON object."""
+    wsp = obj.get(KEY_WORKSPACE)
+    if isinstance(wsp, dict):
+        return wsp.get(KEY_ID)
+    return obj.get('wid')
+
+def client_of(obj):
+    """Returns the client id of a project JSON object."""
+    cli = obj.get(KEY_CLIENT)
+    if isinstance(cli, dict):
+        return cli.get(KEY_ID)
+    return obj.get('cid')
+
+FUZZY_FETCHES = {'projects': 'get_projects', 'clients': 'get_clients',
+    'workspaces': 'get_workspaces'}
+
+_fuzzy_index = None
+
+def load_fuzzy_index():
+    """Returns a TogglFuzzyIndex over the cached trigram tables, building the
+       tables in memory from the collections when they are not cached. The
+       index is loaded once per run."""
+    global _fuzzy_index
+    if _fuzzy_index is not None:
+        return _fuzzy_index
+    tables = {}
+    for collection in FUZZY_COLLECTIONS:
+        table = None
+        if toggl_cache.enabled:
+            table = toggl_cache.read_fuzzy_tables(collection)
+        if table is None:
+            objs = load_all(collection, getattr(toggl, FUZZY_FETCHES[collection]))
+            table = TogglFuzzyIndex.build_table([o.fields for o in objs])
+        tables[collection] = table
+    _fuzzy_index = TogglFuzzyIndex(tables)
+    return _fuzzy_index
+
+FUZZY_CANDIDATES = 5
+# The best match is taken without asking when it is this good and this far
+# ahead of the next one.
+FUZZY_CLEAR_SCORE = 0.9
+FUZZY_CLEAR_MARGIN = 0.15
+
+def fuzzy_find_project(query, ask=False, announce=False):
+    """Finds a project by fuzzy query, asking which one was meant when the
+       best candidates are too close to call. With ask set, even a clear
+       winner is only taken once the user confirms it; with announce set, it
+       is taken but named on stderr."""
+    matches = load_fuzzy_index().search(query, FUZZY_CANDIDATES)
+    if not matches:
+        return None
+    best = matches[0]
+    if best[0] >= FUZZY_CLEAR_SCORE and (len(matches) == 1 or
+            best[0] - matches[1][0] >= FUZZY_CLEAR_MARGIN):
+        chosen = best
+        if ask:
+            sys.stderr.write("'%s' is not a project; the closest is %s [%s].\n" %
+                    (query, best[2], best[1]))
+            if not sys.stdin.isatty() or not confirm("Use it? [y/N] "):
+                return None
+        elif announce:
+            sys.stderr.write("'%s' is not a project; using %s [%s].\n" %
+                    (query, best[2], best[1]))
+    else:
+        sys.stderr.write("'%s' is ambiguous:\n" % query)
+        for i, (score, proj_id, name) in enumerate(matches):
+            sys.stderr.write("  %d) %s [%s]\n" % (i + 1, name, proj_id))
+        if not sys.stdin.isatty():
+            return None
+        choice = prompt("Which project? [1-%d, Enter to cancel] " % len(matches))
+        if not choice.isdigit() or not 1 <= int(choice) <= len(matches):
+            return None
+        chosen = matches[int(choice) - 1]
+    return find_in_collection("projects", str(chosen[1]), toggl.get_projects, TogglProject)
+
+def find_in_collection(collection, key, fetch, cls, exact_name=False):
+    """Finds the first object whose id equals key or whose name starts with
+       it, or only the first named exactly key if exact_name is set. Uses
+       the memory-mapped cache index when there is one, so only the
+       matching record is decoded."""
+    shards = [None]
+    if toggl_cache.sharded and collection in SHARDED_COLLECTIONS:
+        shards = toggl_cache.shard_ids(collection)
+    indexes = []
+    if toggl_cache.enabled:
+        indexes = [toggl_cache.open_index(collection, wsp) for wsp in shards]
+    if indexes and None not in indexes:
+        fields = None
+        try:
+            for index in indexes:
+                fields = index.find_name(key) if exact_name else index.find(key)
+                if fields is not None:
+                    break
+        finally:
+            for index in indexes:
+                toggl_cache.record(collection, 'bytes_read', index.bytes_read)
+                index.close()
+        return cls(fields) if fields is not None else None
+    for index in indexes:
+        if index is not None:
+            index.close()
+
+    for obj in load_all(collection, fetch):
+        if exact_name:
+            if obj.name == key:
+                return obj
+        elif str(obj.id) == key or obj.name.startswith(key):
+            return obj
+    return None
+
+def store_write_through(entries=(), removed_ids=()):
+    """Applies entries added, edited or deleted by this tool to the local
+       entry store, if there is one, keeping its rollups current."""
+    if not toggl_cache.has_store():
+        return
+    store = toggl_cache.open_store()
+    try:
+        store.upsert(entries)
+        store.delete(removed_ids)
+    finally:
+        store.close()
+
+def write_through(collection, objs, removed_ids=()):
+    """Merges objects returned by a mutation into the cached collection.
+       When sharded, each object goes to its workspace's shard and is
+       dropped from the others, in case it moved between workspaces."""
+    if not toggl_cache.enabled:
+        return
+    if not (toggl_cache.sharded and collection in SHARDED_COLLECTIONS):
+        toggl_cache.merge_collection(collection, objs, removed_ids)
+        return
+
+    by_workspace = {}
+    for obj in objs:
+        by_workspace.setdefault(str(workspace_of(obj)), []).append(obj)
+    for wsp in toggl_cache.shard_ids(collection):
+        moved = [obj[KEY_ID] for obj in objs if str(workspace_of(obj)) != wsp]
+        toggl_cache.merge_collection(collection, by_workspace.get(wsp, []),
+                list(removed_ids) + moved, workspace=wsp)
+
+def write_through_projects(resp):
+    """Merges the projects returned by a mutation into the project cache."""
+    write_through("projects", response_objects(resp))
+
+def write_through_clients(resp, removed_ids=()):
+    """Merges the clients returned by a mutation into the client cache."""
+    write_through("clients", response_objects(resp), removed_ids)
 
 def check_feature_support(proj):
     wsp = find_workspace(str(proj.workspace.id)) if proj.workspace else None
@@ -125,42 +1242,104 @@ def check_feature_support(proj):
 def json_format(text):
     return json.dumps(text, sort_keys=False, indent=4, separators=(',', ':'))
 
+ISO_TIME_RE = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?(Z|[+-]\d\d:?\d\d)$')
+
+def parse_iso_time(timestr):
+    """Parses the ISO 8601 timestamps the API returns without going through
+       dateutil, falling back to it for anything else."""
+    m = ISO_TIME_RE.match(timestr)
+    if m is None:
+        return date_parser.parse(timestr)
+    offset = m.group(7)
+    if offset == 'Z':
+        tzinfo = pytz.utc
+    else:
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        tzinfo = pytz.FixedOffset(-minutes if offset[0] == '-' else minutes)
+    return datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)),
+            int(m.group(4)), int(m.group(5)), int(m.group(6)), tzinfo=tzinfo)
+
+class TogglEntryFormatter:
+    """Formats time entries for output. The timezone, date formats and
+       duration units are read from the config once per run instead of
+       once per line."""
+
+    def __init__(self):
+        self.tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
+        self.date_fmt = DEFAULT_DATEFMT
+        if toggl_cfg.has_option('options', 'datefmt'):
+            self.date_fmt = toggl_cfg.get('options', 'datefmt')
+        self.entry_date_fmt = DEFAULT_ENTRY_DATEFMT
+        if toggl_cfg.has_option('options', 'entry_datefmt'):
+            self.entry_date_fmt = toggl_cfg.get('options', 'entry_datefmt')
+
+    def local_time(self, timestr):
+        return parse_iso_time(timestr).astimezone(self.tz)
+
+    def day(self, entry):
+        """Returns the date heading the entry is listed under."""
+        return self.local_time(entry.start_time).strftime(self.date_fmt)
+
+    def entry(self, entry, show_proj=True, verbose=False):
+        # If the duration is negative, the entry is currently running so we
+        # have to calculate the duration by adding the current time.
+        is_running = ''
+
+        e_time_str = " %s" % elapsed_time(int(get_entry_duration(entry)), separator='')
+
+        # Get the project name (if one exists).
+        project_name = ''
+        if entry.project == None:
+            project_name = " (No Project)"
+        elif show_proj:
+            project_name = " @%s" % entry.project.name
+        else:
+            project_name = " %s" % self.local_time(entry.start_time).date()
+
+        if verbose:
+            st = self.local_time(entry.start_time).strftime(self.entry_date_fmt)
+            if entry.stop_time == None:
+                et = ""
+            else:
+                et = self.local_time(entry.stop_time).strftime(self.entry_date_fmt)
+
+            return "[%s] %s%s%s%s (%s - %s)" % (entry.id, is_running, entry.desc, \
+                    project_name, e_time_str, st, et)
+        else:
+            return "%s%s%s%s" % (is_running, entry.desc, project_name, e_time_str)
+
+_formatter = None
+
+def get_formatter():
+    global _formatter
+    if _formatter is None:
+        _formatter = TogglEntryFormatter()
+    return _formatter
+
 def format_time_entry(entry, show_proj=True, verbose=False):
     """Utility function to print a time entry object and returns the
        integer duration for this entry."""
+    return get_formatter().entry(entry, show_proj, verbose)
 
-    # If the duration is negative, the entry is currently running so we
-    # have to calculate the duration by adding the current time.
-    is_running = ''
-
-    e_time_str = " %s" % elapsed_time(int(get_entry_duration(entry)), separator='')
- 
-    # Get the project name (if one exists).
-    tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
-    project_name = ''
-    if entry.project == None:
-        project_name = " (No Project)"
-    elif show_proj:
-        project_name = " @%s" % entry.project.name
-    else:
-        start_time = date_parser.parse(entry.start_time).astimezone(tz)
-        project_name = " %s" % start_time.date()
+class TogglOutput:
+    """Collects output lines and writes them to stdout in large blocks."""
 
-    if verbose:
-        date_fmt = DEFAULT_ENTRY_DATEFMT
-        if toggl_cfg.has_option('options', 'entry_datefmt'):
-            date_fmt = toggl_cfg.get('options', 'entry_datefmt')
+    def __init__(self, stream=None, lines_per_write=1024):
+        self._stream = stream if stream is not None else sys.stdout
+        self._lines_per_write = lines_per_write
+        self._lines = []
 
-        st = date_parser.parse(entry.start_time).astimezone(tz).strftime(date_fmt)
-        if entry.stop_time == None:
-            et = ""
-        else:
-            et = date_parser.parse(entry.stop_time).astimezone(tz).strftime(date_fmt)
+    def write(self, line):
+        self._lines.append(line)
+        if len(self._lines) >= self._lines_per_write:
+            self.flush()
 
-        return "[%s] %s%s%s%s (%s - %s)" % (entry.id, is_running, entry.desc, \
-                project_name, e_time_str, st, et)
-    else:
-        return "%s%s%s%s" % (is_running, entry.desc, project_name, e_time_str)
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            self._stream.write('\n'.join(self._lines))
+            self._lines = []
+        self._stream.flush()
 
 def format_project_entry(proj, verbose=False):
     proj_id = ""
@@ -246,7 +1425,7 @@ def add_time_entry(args):
     entry.desc = args.msg
     
     if args.proj is not None:
-        entry.project = find_project(args.proj)
+        entry.project = find_project(args.proj, announce=True)
         if not entry.project:
             print("Could not find project!")
             return False
@@ -273,6 +1452,7 @@ def add_time_entry(args):
     
     # Send the data.
     resp = toggl.add_time_entry(entry)
+    store_write_through([TogglEntry(e) for e in response_objects(resp)])
 
     if args.verbose:
         print(json_format(resp))
@@ -281,11 +1461,169 @@ def add_time_entry(args):
     
     return True
 
+class TogglProgress:
+    """Thread-safe progress meter written to stderr."""
+
+    def __init__(self, total, label):
+        self.total = total
+        self.label = label
+        self.done = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def step(self, ok=True):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            sys.stderr.write("\r%s %d/%d (%d failed)" % (self.label, self.done,
+                self.total, self.failed))
+            if self.done == self.total:
+                sys.stderr.write("\n")
+            sys.stderr.flush()
+
+JOURNAL_SUFFIX = '.journal'
+
+class TogglJournal:
+    """Records the ids a bulk operation has finished, so an interrupted run
+       can be resumed. The first line identifies the operation; a journal
+       for a different operation is never resumed."""
+
+    def __init__(self, name, key):
+        self.path = "%s/%s%s" % (toggl_cache.path, name, JOURNAL_SUFFIX)
+        self.key = key
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _lines(self):
+        """Returns the journal's lines if it belongs to this operation."""
+        try:
+            f = open(self.path, "r")
+            lines = f.read().splitlines()
+            f.close()
+        except IOError:
+            return []
+        if not lines or lines[0] != self.key:
+            return []
+        return lines
+
+    def completed(self):
+        """Returns the ids finished by a previous run of the same operation."""
+        return set(self._lines()[1:])
+
+    def start(self, resume):
+        """Opens the journal for recording. Resuming appends to the journal
+           of the same operation; anything else starts a new one."""
+        if resume and self._lines():
+            self._file = open(self.path, "a")
+        else:
+            self._file = open(self.path, "w")
+            self._file.write(self.key + "\n")
+            self._file.flush()
+
+    def record(self, obj_id):
+        with self._lock:
+            self._file.write("%s\n" % obj_id)
+            self._file.flush()
+
+    def finish(self, success):
+        self._file.close()
+        if success:
+            os.remove(self.path)
+
+def prompt(text):
+    try:
+        answer = raw_input(text)
+    except NameError:
+        answer = input(text)
+    return answer.strip()
+
+def confirm(text):
+    return prompt(text).lower() in ('y', 'yes')
+
+def bulk_edit_time_entries(args):
+    """Applies -p/-m/-d to every entry in the -s/-e range whose description
+       matches --grep: shows the plan, then updates the entries concurrently
+       through the request scheduler."""
+    proj = None
+    if args.proj is not None:
+        proj = find_project(args.proj, announce=True)
+        if not proj:
+            print("Could not find project!")
+            return False
+    if proj is None and args.msg is None and args.duration is None:
+        print("Nothing to change; give -p, -m or -d.")
+        return False
+
+    # The journal is keyed on the resolved range, not -s/-e as given, so a
+    # default or relative range resumed on a later day is a different run.
+    start_date, end_date = time_range(args.start, args.end)
+    key = json.dumps([args.grep, calendar.timegm(start_date.utctimetuple()),
+            calendar.timegm(end_date.utctimetuple()), args.proj, args.msg, args.duration])
+    journal = TogglJournal('bulk-edit', key)
+    done = journal.completed() if args.resume else set()
+    fetched = entries_from_fields(toggl.stream_time_entry_fields(end_date, start_date))
+    entries = [e for e in filter_entries(fetched, args.grep) if str(e.id) not in done]
+
+    fmt = get_formatter()
+    for entry in entries:
+        change = []
+        if proj is not None:
+            change.append("@%s" % proj.name)
+        if args.msg is not None:
+            change.append("'%s'" % args.msg)
+        if args.duration is not None:
+            change.append(args.duration)
+        print("%s -> %s" % (fmt.entry(entry, verbose=True), ' '.join(change)))
+    print("%d entries to update%s." % (len(entries),
+        " (%d already done)" % len(done) if done else ""))
+    if not entries or args.dry_run:
+        return True
+    if not args.yes and not confirm("Apply? [y/N] "):
+        return False
+
+    progress = TogglProgress(len(entries), "Updating")
+    journal.start(args.resume)
+
+    def update(entry):
+        if proj is not None:
+            entry.project = proj
+        if args.msg is not None:
+            entry.desc = args.msg
+        if args.duration is not None:
+            entry.duration = parse_duration(args.duration)
+        try:
+            resp = toggl.update_time_entry(entry)
+        except requests.RequestException:
+            resp = None
+        ok = resp is not None and resp.success
+        if ok:
+            journal.record(entry.id)
+        progress.step(ok)
+        return resp
+
+    results = parallel_map(update, entries)
+    updated = [r for r in results if r is not None and r.success]
+    store_write_through([TogglEntry(e) for r in updated for e in response_objects(r)])
+    journal.finish(progress.failed == 0)
+    if progress.failed:
+        print("%d updates failed; run again with --resume to retry them." % progress.failed)
+        return False
+    print("Updated %d entries." % len(updated))
+    return True
+
 def edit_time_entry(args):
     """Update an existing time entry"""
 
     if args.verbose:
         print(args)
+
+    if args.grep is not None:
+        return bulk_edit_time_entries(args)
+    if args.id is None:
+        print("Specify the entry to edit with -i, or select entries with --grep.")
+        return False
+
     # Get an array of objects of recent time data.
     entry = toggl.get_time_entry(args.id)
 
@@ -294,7 +1632,7 @@ def edit_time_entry(args):
         return False
 
     if args.proj != None:
-        entry.project = find_project(args.proj)
+        entry.project = find_project(args.proj, announce=True)
         if not entry.project:
             print("Could not find project!")
             return False
@@ -319,6 +1657,7 @@ def edit_time_entry(args):
             entry.duration = parse_duration(args.duration)
 
     resp = toggl.update_time_entry(entry)
+    store_write_through([TogglEntry(e) for e in response_objects(resp)])
 
     return True
             
@@ -344,13 +1683,13 @@ def parse_estimate(est):
 
     return int(est) * mult
 
-def elapsed_time(seconds, suffixes=['y','w','d','h','m','s'], add_s=False, separator=' '):
-    """
-    Takes an amount of seconds and turns it into a human-readable amount of time.
-    From http://snipplr.com/view.php?codeview&id=5713
-    """
-    # the formatted time string to be returned
-    time = []
+_elapsed_parts = {}
+
+def elapsed_parts(suffixes):
+    """Returns the (suffix, seconds) units elapsed_time splits a duration
+       into, computed once per set of suffixes."""
+    if suffixes in _elapsed_parts:
+        return _elapsed_parts[suffixes]
 
     # the pieces of time to iterate over (days, hours, minutes, etc)
     # - the first piece in each tuple is the suffix (d, h, w)
@@ -369,6 +1708,18 @@ def elapsed_time(seconds, suffixes=['y','w','d','h','m','s'], add_s=False, separ
               (suffixes[3], 60 * 60),
               (suffixes[4], 60),
               (suffixes[5], 1)]
+    _elapsed_parts[suffixes] = parts
+    return parts
+
+def elapsed_time(seconds, suffixes=['y','w','d','h','m','s'], add_s=False, separator=' '):
+    """
+    Takes an amount of seconds and turns it into a human-readable amount of time.
+    From http://snipplr.com/view.php?codeview&id=5713
+    """
+    # the formatted time string to be returned
+    time = []
+
+    parts = elapsed_parts(tuple(suffixes))
     
     # for each time piece, grab the value and remaining seconds, and add it to
     # the time string
@@ -393,36 +1744,155 @@ def get_current_time_entry():
     
     return None
 
-def get_time_entries(start=None, end=None):
-    """Fetches time entry data and returns it as a Python array."""
-    
+def time_range(start=None, end=None):
+    """Returns the (earlier, later) datetimes for a -s/-e pair of local
+       dates, defaulting to the start of this week and the end of today."""
     tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
 
-    end_date = None
     # Construct the start and end dates. Toggl seems to want these in UTC.
     if start != None:
-        lt = tz.localize(date_parser.parse(args.start))
-        end_date = lt.astimezone(pytz.utc)
+        lt = tz.localize(date_parser.parse(start))
+        start_date = lt.astimezone(pytz.utc)
     else:
-        endday = datetime.datetime.now(pytz.utc)
+        startday = datetime.datetime.now(pytz.utc)
         # Set the default start day to monday
-        if endday.weekday() != 0:
-            endday = endday - datetime.timedelta(days=endday.weekday())
-        end_date = tz.localize(datetime.datetime(endday.year, endday.month, endday.day, 0, 0, 0))
- 
-    start_date = None
-    # The end date is actually earlier in time than start date
+        if startday.weekday() != 0:
+            startday = startday - datetime.timedelta(days=startday.weekday())
+        start_date = tz.localize(datetime.datetime(startday.year, startday.month, startday.day, 0, 0, 0))
+
     if end != None:
-        lt = tz.localize(date_parser.parse(args.end))
-        start_date = lt.astimezone(pytz.utc)
+        lt = tz.localize(date_parser.parse(end))
+        end_date = lt.astimezone(pytz.utc)
     else:
-        today = datetime.datetime.now()
-        start_date = today.replace(hour=23, minute=59, second=59)
-    
-    return toggl.get_time_entries(start_date, end_date)
+        today = datetime.datetime.now(tz).replace(tzinfo=None)
+        end_date = tz.localize(today.replace(hour=23, minute=59, second=59))
+
+    return start_date, end_date
+
+def entries_from_fields(fields):
+    """Yields a TogglEntry for each decoded JSON object, charging the
+       decoding and the objects to their --memprofile stages."""
+    return mem_stage_iter('model',
+            (TogglEntry(f) for f in mem_stage_iter('decode', fields)))
+
+def get_time_entries(start=None, end=None):
+    """Fetches time entry data and yields the entries as they are decoded."""
+    start_date, end_date = time_range(start, end)
+
+    # The API takes the later date first.
+    return entries_from_fields(toggl.stream_time_entry_fields(end_date, start_date))
+
+DEFAULT_WATCH_POLL_SECONDS = 15
+WATCH_REDRAW_SECONDS = 1
+CLEAR_SCREEN = "\033[H\033[2J"
+
+class TogglWatcher:
+    """Keeps the latest result of fetch(validators) current from a background
+       thread. fetch returns None when nothing changed since the request the
+       validators describe, so unchanged polls cost a 304 and no decoding."""
+
+    def __init__(self, fetch, interval):
+        self._fetch = fetch
+        self._interval = interval
+        self._validators = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.value = None
+        self.error = None
+        self.checked = None
+
+    def poll(self):
+        try:
+            value = self._fetch(self._validators)
+            error = None
+        except Exception as e:
+            # Any failure, a bad response included, must not end the thread:
+            # it is shown in the status line and the next poll tries again.
+            value = None
+            error = str(e) or e.__class__.__name__
+        with self._lock:
+            if value is not None:
+                self.value = value
+            self.error = error
+            self.checked = time.time()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.poll()
+
+    def start(self):
+        self.poll()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        with self._lock:
+            return self.value, self.error, self.checked
+
+def watch_poll_seconds():
+    if toggl_cfg.has_option('options', 'watch_poll_seconds'):
+        return toggl_cfg.getfloat('options', 'watch_poll_seconds')
+    return DEFAULT_WATCH_POLL_SECONDS
+
+def watch(fetch, render):
+    """Redraws render(entries) every second until interrupted, while a
+       TogglWatcher polls fetch in the background. Running entries show
+       their elapsed time as of each redraw."""
+    interval = watch_poll_seconds()
+    watcher = TogglWatcher(fetch, interval)
+    watcher.start()
+    try:
+        while True:
+            entries, error, checked = watcher.snapshot()
+            sys.stdout.write(CLEAR_SCREEN)
+            render(entries or [])
+            status = "Checked %s, every %gs." % (time.strftime("%H:%M:%S",
+                time.localtime(checked)), interval)
+            if error:
+                status += " Last check failed: %s" % error
+            sys.stdout.write(status + "\n")
+            sys.stdout.flush()
+            time.sleep(WATCH_REDRAW_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+    return True
+
+def watch_current_time_entry(args):
+    """Shows the running entry and today's total, updated live."""
+    tz = get_formatter().tz
+
+    def fetch(validators):
+        today = datetime.datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+        # Look back a day so an entry started yesterday is still found.
+        return toggl.poll_time_entries(today + datetime.timedelta(days=1),
+                today - datetime.timedelta(days=1), validators)
+
+    def render(entries):
+        fmt = get_formatter()
+        today = datetime.datetime.now(tz).date()
+        running = [e for e in entries if int(e.duration) < 0]
+        if running:
+            print(fmt.entry(running[-1], verbose=args.verbose_list))
+        else:
+            print("You're not working on anything right now.")
+        total = sum(get_entry_duration(e) for e in entries
+                if parse_iso_time(e.start_time).astimezone(tz).date() == today)
+        print("Today: %s" % (elapsed_time(int(total)) or "0s"))
+
+    return watch(fetch, render)
 
 def list_current_time_entry(args):
     """Shows what the user is currently working on (duration is negative)."""
+    if args.watch:
+        return watch_current_time_entry(args)
+
     entry = get_current_time_entry()
     if entry != None:
         print(format_time_entry(entry, verbose=args.verbose_list))
@@ -440,17 +1910,6 @@ def list_projects(args):
         if toggl_cfg.has_option('options', 'show_archived_projects'):
             show_archived = toggl_cfg.getboolean('options', 'show_archived_projects')
 
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        if not args.update_cache:
-            raw.response_data = toggl_cache.read_project_cache()
-
-    proj_list = toggl.get_projects(raw_data=raw)
-
-    if args.update_cache:
-        toggl_cache.update_project_cache(raw.response_data)
-
     wsp = None
     if args.workspace:
         wsp = find_workspace(args.workspace)
@@ -458,6 +1917,11 @@ def list_projects(args):
             print("Could not find specified workspace!")
             return False
 
+    if wsp is not None and toggl_cache.sharded:
+        proj_list = load_shards("projects", [wsp], args.update_cache)
+    else:
+        proj_list = load_all("projects", toggl.get_projects, args.update_cache)
+
     for proj in proj_list:
         if not proj.is_active and not show_archived:
             continue
@@ -468,75 +1932,62 @@ def list_projects(args):
 
     return True
 
-def find_project(proj):
-    """Find a project given the unique prefix of the name"""
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        raw.response_data = toggl_cache.read_project_cache()
-
-    proj_list = toggl.get_projects(raw_data=raw)
+def find_project(proj, ask=False, announce=False):
+    """Find a project given its id, the unique prefix of its name or, failing
+       those, a fuzzy match on the project, client and workspace names. Set
+       ask where a wrong guess would change the wrong project, so that any
+       fuzzy match is confirmed first, and announce where a wrong guess would
+       log time to it, so that the match is at least named."""
     if proj.startswith('@') and proj in alias_dict:
+        # An alias names a project in full; only fall back to a prefix
+        # match if no project has exactly that name.
+        found = find_in_collection("projects", alias_dict[proj],
+                toggl.get_projects, TogglProject, exact_name=True)
+        if found is not None:
+            return found
         proj = alias_dict[proj]
-    for project in proj_list:
-        if str(project.id) == proj or project.name.startswith(proj):
-            return project
-    return None
+    found = find_in_collection("projects", proj, toggl.get_projects, TogglProject)
+    if found is None and not proj.isdigit():
+        found = fuzzy_find_project(proj, ask, announce)
+    return found
+
+def search_projects(query):
+    """Lists the projects matching a fuzzy query, best first."""
+    matches = load_fuzzy_index().search(query)
+    for score, proj_id, name in matches:
+        print("%3d%% [%s] %s" % (score * 100, proj_id, name))
+    return bool(matches)
 
 def list_workspaces(args):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        if not args.update_cache:
-            raw.response_data = toggl_cache.read_workspace_cache()
-
-    wsp_list = toggl.get_workspaces(raw_data=raw)
-
-    if args.update_cache:
-        toggl_cache.update_workspace_cache(raw.response_data)
+    wsp_list = load_collection("workspaces", toggl.get_workspaces, args.update_cache)
 
     for wsp in wsp_list:
         print(format_workspace_entry(wsp, args.verbose_list))
     return True
 
 def find_workspace(wkspc):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        raw.response_data = toggl_cache.read_workspace_cache()
-
-    wsp_list = toggl.get_workspaces(raw_data=raw)
-    for wsp in wsp_list:
-        if str(wsp.id) == wkspc or wsp.name.startswith(wkspc):
-            return wsp
-    return None
+    return find_in_collection("workspaces", wkspc, toggl.get_workspaces, TogglWorkspace)
 
 def list_clients(args):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        if not args.update_cache:
-            raw.response_data = toggl_cache.read_client_cache()
-
-    cl_list = toggl.get_clients(raw_data=raw)
+    wsp = None
+    if args.workspace:
+        wsp = find_workspace(args.workspace)
+        if wsp is None:
+            print("Could not find specified workspace!")
+            return False
 
-    if args.update_cache:
-        toggl_cache.update_client_cache(raw.response_data)
+    if wsp is not None and toggl_cache.sharded:
+        cl_list = load_shards("clients", [wsp], args.update_cache)
+    else:
+        cl_list = load_all("clients", toggl.get_clients, args.update_cache)
 
     for cl in cl_list:
+        if wsp is not None and cl.workspace is not None and wsp.id != cl.workspace.id:
+            continue
         print(format_client_entry(cl, args.verbose_list))
 
 def find_client(client):
-    raw = None
-    if toggl_cache.enabled:
-        raw = TogglRawData()
-        raw.response_data = toggl_cache.read_client_cache()
-
-    cli_list = toggl.get_clients(raw_data=raw)
-    for cli in cli_list:
-        if str(cli.id) == client or cli.name.startswith(client):
-            return cli
-    return None
+    return find_in_collection("clients", client, toggl.get_clients, TogglClient)
 
 def list_tasks(args):
     active = False if args.list_inactive else True
@@ -551,84 +2002,490 @@ def find_task(task):
             return task
     return None
 
-def list_time_entries_date(entries):
-    date_fmt = DEFAULT_DATEFMT
-    if toggl_cfg.has_option('options', 'datefmt'):
-        date_fmt = toggl_cfg.get('options', 'datefmt')
-
-    # Sort the time entries into buckets based on "Month Day" of the entry.
-    days = {}
-    for entry in entries:
-        tz = pytz.timezone(toggl_cfg.get('options', 'timezone'))
-        start_time = date_parser.parse(entry.start_time).astimezone(tz).strftime(date_fmt)
-        if start_time not in days:
-            days[start_time] = []
-        days[start_time].append(entry)
+def iter_days(entries, presorted=False):
+    """Groups the entries by the day they start on, yielding (day, entries)
+       pairs. Unless presorted is set, all of the entries are bucketed first
+       and the days yielded in sorted order, so each day comes out once.
+       Entries known to be sorted by start, as the API and the store return
+       them, are grouped a day at a time instead; should a start still go
+       back in time, the rest are gathered and sorted first."""
+    fmt = get_formatter()
+    if not presorted:
+        days = {}
+        for entry in entries:
+            days.setdefault(fmt.day(entry), []).append(entry)
+        for day in sorted(days.keys()):
+            yield day, days[day]
+        return
+
+    stream = iter(entries)
+    day = None
+    group = []
+    last_start = None
+    for entry in stream:
+        start = fmt.local_time(entry.start_time)
+        if last_start is not None and start < last_start:
+            rest = group + [entry] + list(stream)
+            rest.sort(key=lambda e: parse_iso_time(e.start_time))
+            for pair in iter_days(rest, presorted=True):
+                yield pair
+            return
+        last_start = start
+        entry_day = start.strftime(fmt.date_fmt)
+        if entry_day != day:
+            if group:
+                yield day, group
+            day = entry_day
+            group = []
+        group.append(entry)
+    if group:
+        yield day, group
+
+def list_time_entries_date(entries, presorted=False):
+    """Prints the entries grouped by day. When presorted is set, each day is
+       printed as soon as the next one begins (see iter_days)."""
+    fmt = get_formatter()
+    out = TogglOutput()
 
     dur_sum = 0
     # For each day, print the entries, then sum the times.
-    for date_str in sorted(days.keys()):
-        print(date_str)
-
-        duration = 0
-        for entry in days[date_str]:
-            duration += get_entry_duration(entry)
-            if not args.quiet:
-                print("   %s" % format_time_entry(entry, verbose=args.verbose_list))
-        print("   (%s)" % elapsed_time(int(duration)))
-        dur_sum += duration
+    for date_str, day_entries in mem_stage_iter('bucketing', iter_days(entries, presorted)):
+        with mem_stage('format'):
+            out.write(date_str)
+            duration = 0
+            for entry in day_entries:
+                e_duration = get_entry_duration(entry)
+                duration += e_duration
+                if not args.quiet:
+                    out.write("   %s" % fmt.entry(entry, verbose=args.verbose_list))
+            out.write("   (%s)" % elapsed_time(int(duration)))
+            dur_sum += duration
 
     if args.sum:
-        print("Total time: %s" % elapsed_time(dur_sum))
+        out.write("Total time: %s" % elapsed_time(dur_sum))
+    out.flush()
     return True
 
 def list_time_entries_project(entries):
+    fmt = get_formatter()
+    out = TogglOutput()
+
     projs = {}
-    for entry in entries:
-        if entry.project == None:
-            proj = '(No Project)'
-        else:
-            proj = entry.project.name
-        if proj not in projs:
-            projs[proj] = []
-        projs[proj].append(entry)
+    with mem_stage('bucketing'):
+        for entry in entries:
+            if entry.project == None:
+                proj = '(No Project)'
+            else:
+                proj = entry.project.name
+            if proj not in projs:
+                projs[proj] = []
+            projs[proj].append(entry)
     
     dur_sum = 0
-    for proj in projs.keys():
-        print("@" + proj)
-        duration = 0
-        for entry in projs[proj]:
-            duration += get_entry_duration(entry)
-            if not args.quiet:
-                print("   %s" % format_time_entry(entry, show_proj=False, verbose=args.verbose_list))
-        print("   (%s)" % (elapsed_time(int(duration))))
-        dur_sum += duration
+    with mem_stage('format'):
+        for proj in projs.keys():
+            out.write("@" + proj)
+            duration = 0
+            for entry in projs[proj]:
+                duration += get_entry_duration(entry)
+                if not args.quiet:
+                    out.write("   %s" % fmt.entry(entry, show_proj=False, verbose=args.verbose_list))
+            out.write("   (%s)" % (elapsed_time(int(duration))))
+            dur_sum += duration
 
     if args.sum:
-        print("Total time: %s" % elapsed_time(dur_sum))
+        out.write("Total time: %s" % elapsed_time(dur_sum))
+    out.flush()
     return True
 
 def filter_match(entry, pattern):
     return re.search(pattern, entry.desc)
 
 def filter_entries(entries, pattern):
-    return [e for e in entries if filter_match(e, pattern)]
+    return (e for e in entries if filter_match(e, pattern))
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+SPAN_RE = re.compile(r'^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?$')
+FILTER_TERM_RE = re.compile(r'^(!?)(\w+)(?:(~|>=|<=|>|<|:|=)(.*))?$')
+
+def parse_span(text):
+    """Parses a duration written as 1h30m, 90m, 45s or [[H:]M:]S."""
+    m = SPAN_RE.match(text)
+    if m and any(m.groups()):
+        h, mi, sec = [int(g or 0) for g in m.groups()]
+        return h * 3600 + mi * 60 + sec
+    return parse_duration(text)
+
+def parse_weekdays(text):
+    """Parses mon-fri, sat,sun and the like into a set of weekday numbers."""
+    days = set()
+    for part in text.lower().split(','):
+        ends = [WEEKDAYS.index(d[:3]) for d in part.split('-')]
+        if len(ends) == 1:
+            days.add(ends[0])
+        else:
+            day = ends[0]
+            days.add(day)
+            while day != ends[1]:
+                day = (day + 1) % 7
+                days.add(day)
+    return days
+
+def parse_time_of_day(text):
+    """Parses 09:00-17:30 into minutes since midnight; the range may wrap
+       past midnight."""
+    parts = text.split('-')
+    if len(parts) != 2:
+        raise ValueError("Time range '%s' should look like 09:00-17:00" % text)
+    ends = []
+    for part in parts:
+        h, m = (part.split(':') + ['0'])[:2]
+        ends.append(int(h) * 60 + int(m))
+    return ends[0], ends[1]
+
+class TogglFilter:
+    """A compiled ls filter expression: whitespace separated terms that must
+       all hold, each optionally negated with a leading '!'.
+
+         project:NAME  client:NAME  ws:NAME  billable  running
+         dur>1h  dur<=90m  desc~REGEX  weekday:mon-fri  time:09:00-17:00
+
+       Names are resolved once, like -p arguments. Terms the entry store
+       can evaluate are also returned as SQL by where(); the rest run in
+       Python on each entry. Duration terms are split: the store decides
+       stopped entries and running ones, whose elapsed time only Python
+       knows, are passed on to the residual test."""
+
+    def __init__(self, expr):
+        self.tests = []
+        self.clauses = []
+        self.exact = []
+        self.params = []
+        for term in shlex.split(expr):
+            m = FILTER_TERM_RE.match(term)
+            if not m:
+                raise ValueError("Cannot parse filter term '%s'" % term)
+            negate, key, op, value = m.groups()
+            test, clause, params, exact = self._compile(key.lower(), op, value)
+            if negate:
+                test = (lambda t: lambda e: not t(e))(test)
+                if clause is not None:
+                    # A NULL column fails the term, so it passes the negation.
+                    clause = "NOT COALESCE((%s), 0)" % clause
+            if clause is not None and not exact:
+                clause = "(duration < 0 OR %s)" % clause
+            self.tests.append(test)
+            self.clauses.append(clause)
+            self.exact.append(exact)
+            if clause is not None:
+                self.params.extend(params)
+
+    def _compile(self, key, op, value):
+        """Returns (predicate, SQL clause or None, SQL parameters, whether
+           the clause also decides running entries) for a term."""
+        if key in ('project', 'proj'):
+            proj = find_project(value)
+            if proj is None:
+                raise ValueError("Could not find project '%s'" % value)
+            return (lambda e: entry_project_id(e.fields) == proj.id,
+                    "project_id = ?", [proj.id], True)
+        if key == 'client':
+            cli = find_client(value)
+            if cli is None:
+                raise ValueError("Could not find client '%s'" % value)
+            ids = set(p.id for p in load_all("projects", toggl.get_projects)
+                    if client_of(p.fields) == cli.id)
+            return (lambda e: entry_project_id(e.fields) in ids,
+                    "project_id IN (%s)" % ",".join("?" * len(ids)) if ids else "0",
+                    sorted(ids), True)
+        if key in ('ws', 'workspace'):
+            wsp = find_workspace(value)
+            if wsp is None:
+                raise ValueError("Could not find workspace '%s'" % value)
+            return (lambda e: workspace_of(e.fields) == wsp.id,
+                    "workspace_id = ?", [wsp.id], True)
+        if key == 'billable':
+            return (lambda e: bool(e.fields.get(KEY_BILLABLE)), "billable = 1", [], True)
+        if key == 'running':
+            return (lambda e: e.duration < 0, "duration < 0", [], True)
+        if key in ('dur', 'duration') and op in ('>', '>=', '<', '<='):
+            bound = parse_span(value)
+            cmp = {'>': lambda d: d > bound, '>=': lambda d: d >= bound,
+                   '<': lambda d: d < bound, '<=': lambda d: d <= bound}[op]
+            # Running entries store a negative duration; they are checked in
+            # Python against their elapsed time.
+            return (lambda e: cmp(get_entry_duration(e)),
+                    "duration %s ?" % op, [bound], False)
+        if key in ('desc', 'description') and op == '~':
+            try:
+                pattern = re.compile(value)
+            except re.error as e:
+                raise ValueError("Bad regular expression '%s': %s" % (value, e))
+            return (lambda e: pattern.search(e.fields.get(KEY_DESC) or '') is not None,
+                    "description REGEXP ?", [value], True)
+        if key in ('weekday', 'day'):
+            days = parse_weekdays(value)
+            return (lambda e: self._local_start(e).weekday() in days, None, [], True)
+        if key == 'time':
+            first, last = parse_time_of_day(value)
+            def in_range(e):
+                start = self._local_start(e)
+                minute = start.hour * 60 + start.minute
+                if first <= last:
+                    return first <= minute < last
+                return minute >= first or minute < last
+            return (in_range, None, [], True)
+        raise ValueError("Unknown filter term '%s'" % key)
+
+    def _local_start(self, entry):
+        return parse_iso_time(entry.start_time).astimezone(get_formatter().tz)
+
+    def where(self):
+        """Returns the SQL clauses and parameters of the terms the entry
+           store evaluates."""
+        return [c for c in self.clauses if c is not None], self.params
+
+    def residual(self):
+        """Returns the predicate for the terms left after where()."""
+        tests = [t for t, c, exact in zip(self.tests, self.clauses, self.exact)
+                if c is None or not exact]
+        return lambda e: all(t(e) for t in tests)
+
+    def __call__(self, entry):
+        return all(t(entry) for t in self.tests)
+
+def get_filtered_entries(start, end, expr, local=False):
+    """Yields the entries in the range that match the filter expression.
+       From the store, the range and most terms become the WHERE clause;
+       from the API only the range is pushed down and the filter runs as
+       the response streams, so other entries are never kept."""
+    flt = TogglFilter(expr) if expr else None
+    if not local:
+        entries = get_time_entries(start, end)
+        return (e for e in entries if flt(e)) if flt else entries
+
+    start_date, end_date = time_range(start, end)
+    where, params = flt.where() if flt else ([], [])
+    test = flt.residual() if flt else None
+
+    def iter_store():
+        store = toggl_cache.open_store()
+        try:
+            fields = store.iter_entry_fields(calendar.timegm(start_date.utctimetuple()),
+                    calendar.timegm(end_date.utctimetuple()), where, params)
+            for entry in entries_from_fields(fields):
+                if test is None or test(entry):
+                    yield entry
+        finally:
+            store.close()
+    return iter_store()
+
+def remember_entries(entries):
+    """Passes the entries through, then saves the ids of the latest ones
+       for completing -i of edit and rm."""
+    recent = collections.deque(maxlen=COMPLETION_RECENT_ENTRIES)
+    for entry in entries:
+        recent.append(entry.id)
+        yield entry
+    if toggl_cache.enabled:
+        toggl_cache.write_completion_list("ids", "entries", reversed(recent))
+
+def watch_time_entries(args):
+    """Keeps the ls output on screen, updated live."""
+    try:
+        flt = TogglFilter(args.filter) if args.filter else None
+    except ValueError as e:
+        print(e)
+        return False
+
+    def fetch(validators):
+        start_date, end_date = time_range(args.start, args.end)
+        return toggl.poll_time_entries(end_date, start_date, validators)
+
+    def render(entries):
+        if flt:
+            entries = [e for e in entries if flt(e)]
+        if args.grep:
+            entries = filter_entries(entries, args.grep)
+        if args.proj:
+            list_time_entries_project(entries)
+        else:
+            list_time_entries_date(entries)
+
+    return watch(fetch, render)
+
+MEMPROFILE_TOP_SITES = 10
+MEMPROFILE_STAGES = ['decode', 'model', 'bucketing', 'format']
+# A new allocation snapshot is taken each time traced memory grows this much
+# past the last one, so the sites listed are those alive near the peak.
+MEMPROFILE_SNAPSHOT_GROWTH = 1.1
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB']:
+        if abs(n) < 1024:
+            return "%.1f %s" % (n, unit)
+        n /= 1024.0
+    return "%.1f GB" % n
+
+class TogglMemProfile:
+    """Measures a command's memory with tracemalloc, split by the stages
+       the code marks with mem_stage and mem_stage_iter. At each stage
+       boundary the memory allocated less that freed since the last
+       boundary, and the highest traced memory reached meanwhile, are
+       charged to the stage
+       that was running. Stages nest, as when model pulls from decode
+       through a generator, and only the innermost one is charged, so
+       interleaved streaming stages are told apart. Per-stage peaks need
+       Python 3.9's tracemalloc.reset_peak; before that only the overall
+       peak is known."""
+
+    def __init__(self):
+        tracemalloc.start()
+        self._reset_peak = getattr(tracemalloc, 'reset_peak', None)
+        self.running = []
+        self.peaks = dict((name, 0) for name in MEMPROFILE_STAGES + ['other'])
+        self.net = dict((name, 0) for name in MEMPROFILE_STAGES + ['other'])
+        self.peak = 0
+        self.sites = []
+        self._snapshot_size = 0
+        self._last = tracemalloc.get_traced_memory()[0]
+
+    def _charge(self):
+        current, peak = tracemalloc.get_traced_memory()
+        stage = self.running[-1] if self.running else 'other'
+        self.peaks[stage] = max(self.peaks[stage], peak)
+        self.net[stage] += current - self._last
+        # reset_peak also resets the overall peak, so keep the highest.
+        self.peak = max(self.peak, peak)
+        if self._reset_peak is not None and \
+                current > self._snapshot_size * MEMPROFILE_SNAPSHOT_GROWTH:
+            self._snapshot_size = current
+            self._take_sites()
+        self._last = tracemalloc.get_traced_memory()[0]
+        if self._reset_peak is not None:
+            self._reset_peak()
+
+    def _take_sites(self):
+        """Keeps the top allocation sites of a new snapshot. The snapshot
+           itself is traced, which is why this only runs where reset_peak
+           can then hide it from the next stage's peak."""
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)])
+        stats = snapshot.statistics('lineno')
+        self.sites = [(stat.size, stat.count, stat.traceback[0].filename,
+            stat.traceback[0].lineno) for stat in stats[:MEMPROFILE_TOP_SITES]]
+
+    def enter(self, name):
+        self._charge()
+        self.running.append(name)
+
+    def exit(self):
+        self._charge()
+        self.running.pop()
+
+    def report(self, stream=None):
+        """Writes the stage table and the allocation sites holding the most
+           memory near the peak (at the end, before Python 3.9)."""
+        stream = stream if stream is not None else sys.stderr
+        self._charge()
+        if self._reset_peak is None:
+            self._take_sites()
+        tracemalloc.stop()
+        stream.write("%-12s %12s %12s\n" % ("Stage", "Peak", "Net"))
+        for name in MEMPROFILE_STAGES + ['other']:
+            stream.write("%-12s %12s %12s\n" % (name,
+                format_bytes(self.peaks[name]) if self._reset_peak is not None else '-',
+                format_bytes(self.net[name])))
+        stream.write("Overall peak: %s\n" % format_bytes(self.peak))
+        stream.write("Top allocation sites:\n")
+        for size, count, filename, lineno in self.sites:
+            stream.write("  %10s %8d blocks  %s:%d\n" % (format_bytes(size),
+                count, filename, lineno))
+
+class TogglMemStage:
+    """Context manager marking the code it wraps as a TogglMemProfile stage."""
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        if self.profile is not None:
+            self.profile.enter(self.name)
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.exit()
+
+_memprofile = None
+NO_MEM_STAGE = TogglMemStage(None, None)
+
+def init_memprofile(args):
+    """Starts the --memprofile profile. Returns False if tracemalloc is
+       missing."""
+    global _memprofile
+    if not args.memprofile:
+        return True
+    if tracemalloc is None:
+        print("--memprofile needs Python 3.4 or later (tracemalloc).")
+        return False
+    _memprofile = TogglMemProfile()
+    return True
+
+def mem_stage(name):
+    """Marks a with block as a stage of the --memprofile report."""
+    if _memprofile is None:
+        return NO_MEM_STAGE
+    return TogglMemStage(_memprofile, name)
+
+def mem_stage_iter(name, iterable):
+    """Charges the work of producing each item of iterable to a stage of the
+       --memprofile report. Without --memprofile, iterable is returned as
+       is."""
+    if _memprofile is None:
+        return iterable
+    return _mem_stage_iter(_memprofile, name, iterable)
+
+def _mem_stage_iter(profile, name, iterable):
+    it = iter(iterable)
+    while True:
+        profile.enter(name)
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            profile.exit()
+        yield item
 
 def list_time_entries(args):
     """Lists all of the time entries from yesterday and today along with
        the amount of time devoted to each.
     """
 
-    # Get an array of objects of recent time data.
-    entries = get_time_entries(start=args.start, end=args.end)
+    if args.local and not toggl_cache.has_store():
+        print("No local entries; run 'toggl sync' first.")
+        return False
+    if args.watch:
+        if args.local:
+            print("-w polls the API and cannot be combined with -l.")
+            return False
+        return watch_time_entries(args)
+    try:
+        entries = get_filtered_entries(args.start, args.end, args.filter, args.local)
+    except ValueError as e:
+        print(e)
+        return False
+    entries = remember_entries(entries)
 
     if args.grep:
         entries = filter_entries(entries, args.grep)
 
     if args.proj:
-        list_time_entries_project(entries)
+        return list_time_entries_project(entries)
     else:
-        list_time_entries_date(entries)
+        # The API and the store both return entries sorted by start.
+        return list_time_entries_date(entries, presorted=True)
 
 def parse_duration(str):
     """Parses a string of the form [[Hours:]Minutes:]Seconds and returns
@@ -655,16 +2512,156 @@ def get_entry_duration(entry):
         e_time = (datetime.datetime.now(pytz.utc) - date_parser.parse(entry.start_time).astimezone(pytz.utc)).seconds
     return e_time
 
-def delete_time_entry(args):
-    entry_id = args.id
+DEFAULT_BATCH_SIZE = 50
+ID_RANGE_RE = re.compile(r'^(\d+)-(\d+)$')
+# Longest id range accepted, and how many ids a bulk change may touch before
+# it asks for confirmation.
+MAX_ID_RANGE = 10000
+BULK_CONFIRM_COUNT = 10
+
+def batch_size():
+    if toggl_cfg.has_option('options', 'api_batch_size'):
+        return toggl_cfg.getint('options', 'api_batch_size')
+    return DEFAULT_BATCH_SIZE
+
+def split_id_list(spec):
+    """Splits an id list such as "1,2,5-9" into ids, without duplicates,
+       and the remaining tokens, which are left to the caller to resolve by
+       name. A spec of "-" reads the list from stdin, one or more tokens per
+       line. Raises ValueError for a range longer than MAX_ID_RANGE."""
+    if spec == '-':
+        tokens = sys.stdin.read().replace(',', ' ').split()
+    else:
+        tokens = [t.strip() for t in spec.split(',') if t.strip()]
+    ids = []
+    names = []
+    for token in tokens:
+        m = ID_RANGE_RE.match(token)
+        if m:
+            first, last = int(m.group(1)), int(m.group(2))
+            if last - first >= MAX_ID_RANGE:
+                raise ValueError("Range %s spans more than %d ids" % (token, MAX_ID_RANGE))
+            ids.extend(str(i) for i in range(first, last + 1))
+        elif token.isdigit():
+            ids.append(token)
+        else:
+            names.append(token)
+    return list(collections.OrderedDict.fromkeys(ids)), names
 
-    print("Deleting entry %s" % entry_id)
+def confirm_bulk(count, what, yes=False):
+    """Asks before changing more than BULK_CONFIRM_COUNT objects unless -y
+       was given; without a terminal to ask on, -y is required."""
+    if yes or count <= BULK_CONFIRM_COUNT:
+        return True
+    if not sys.stdin.isatty():
+        print("Not changing %d %s without -y." % (count, what))
+        return False
+    return confirm("Change %d %s? [y/N] " % (count, what))
 
-    if not toggl.delete_time_entry(entry_id):
-        print("Entry %s does not exist!" % entry_id)
+def resolve_project_ids(spec):
+    """Resolves an id list to project ids. Names containing wildcards are
+       matched against every cached project; other names go through the
+       project index like any -p argument. Returns None if a name matches
+       nothing or the list is invalid."""
+    try:
+        ids, names = split_id_list(spec)
+    except ValueError as e:
+        print(e)
+        return None
+    projects = None
+    for name in names:
+        if any(c in name for c in '*?['):
+            if projects is None:
+                projects = load_all("projects", toggl.get_projects)
+            matched = [str(p.id) for p in projects if fnmatch.fnmatch(p.name, name)]
+        else:
+            proj = find_project(name, ask=True)
+            matched = [str(proj.id)] if proj is not None else []
+        if not matched:
+            print("Could not find project '%s'!" % name)
+            return None
+        ids.extend(matched)
+    return list(collections.OrderedDict.fromkeys(ids))
+
+def bulk_project_state(spec, func, verb, yes=False):
+    """Archives or reopens the projects in spec, sending batch_size() ids
+       per request with the requests running concurrently."""
+    ids = resolve_project_ids(spec)
+    if ids is None:
+        return False
+    if not confirm_bulk(len(ids), "projects", yes):
         return False
+    batches = list(iter_chunks([int(i) for i in ids], batch_size()))
+    progress = TogglProgress(len(batches), "Batches")
 
-    return True
+    def send(batch):
+        try:
+            resp = func(batch)
+        except requests.RequestException:
+            resp = None
+        ok = resp is not None and resp.success
+        progress.step(ok)
+        return resp
+
+    results = parallel_map(send, batches)
+    changed = 0
+    for resp in results:
+        if resp is not None and resp.success:
+            write_through_projects(resp)
+            changed += len(response_objects(resp))
+    failed = sum(len(b) for b, r in zip(batches, results) if r is None or not r.success)
+    print("%s %d projects, %d failed." % (verb, changed, failed))
+    return failed == 0
+
+def delete_time_entry(args):
+    """Deletes the entries in the id list, one request per entry since the
+       API has no batch delete."""
+    try:
+        ids, names = split_id_list(args.id)
+    except ValueError as e:
+        print(e)
+        return False
+    if names:
+        print("Not an entry id: %s" % ', '.join(names))
+        return False
+    if args.dry_run:
+        print("Would delete %d entries: %s" % (len(ids), ', '.join(ids)))
+        return True
+    if not confirm_bulk(len(ids), "entries", args.yes):
+        return False
+    if len(ids) == 1:
+        print("Deleting entry %s" % ids[0])
+
+    progress = TogglProgress(len(ids), "Deleting") if len(ids) > 1 else None
+
+    def delete(entry_id):
+        try:
+            resp = toggl.delete_time_entry(entry_id)
+        except requests.RequestException:
+            resp = None
+        if progress is not None:
+            progress.step(resp is not None and resp.success)
+        return resp
+
+    results = parallel_map(delete, ids)
+    removed = [i for i, r in zip(ids, results) if r is not None and r.success]
+    missing = [i for i, r in zip(ids, results) if r is not None and not r.success]
+    failed = [i for i, r in zip(ids, results) if r is None]
+    store_write_through(removed_ids=removed)
+
+    if len(ids) == 1:
+        if missing:
+            print("Entry %s does not exist!" % ids[0])
+        elif failed:
+            print("Could not delete entry %s!" % ids[0])
+    else:
+        print("Deleted %d entries, %d not found, %d failed." % (len(removed),
+            len(missing), len(failed)))
+        if missing:
+            print("Not found: %s" % ', '.join(missing))
+        if failed:
+            print("Failed: %s" % ', '.join(failed))
+    return not missing and not failed
 
 def start_time_entry(args):
     """Starts a new time entry."""
@@ -674,7 +2671,7 @@ def start_time_entry(args):
 
     # See if we have a @project.
     if args.proj is not None:
-        entry.project = find_project(args.proj)
+        entry.project = find_project(args.proj, announce=True)
         if not entry.project:
             print("Could not find project!")
             return False
@@ -690,6 +2687,7 @@ def start_time_entry(args):
     entry.duration = -1
 
     resp = toggl.add_time_entry(entry)
+    store_write_through([TogglEntry(e) for e in response_objects(resp)])
 
     if args.verbose:
         print(json_format(resp.data))
@@ -717,7 +2715,8 @@ def stop_time_entry(args):
         entry.stop_time = stop_time.isoformat()
         entry.duration = (stop_time - start_time).seconds
 
-        toggl.update_time_entry(entry)
+        resp = toggl.update_time_entry(entry)
+        store_write_through([TogglEntry(e) for e in response_objects(resp)])
 
     else:
         print("You're not working on anything right now.")
@@ -725,6 +2724,56 @@ def stop_time_entry(args):
 
     return True
 
+def format_budget_entry(proj, seconds):
+    estimate = proj.estimated_workhours
+    if estimate:
+        used = "%5.1f%%" % (100.0 * seconds / (estimate * 3600))
+        est_str = "%.1fh" % estimate
+    else:
+        used = "    -"
+        est_str = "-"
+    return "%s %-40s %12s %14s" % (used, proj.name, est_str, "%.1fh" % (seconds / 3600.0))
+
+def show_budget(args):
+    """Compares each project's estimated hours with the time logged, using
+       the rollups of the local entry store."""
+    if not toggl_cache.has_store():
+        print("No local entries. Run 'toggl sync' over the projects' lifetime first.")
+        return False
+
+    store = toggl_cache.open_store()
+    try:
+        totals = store.project_totals()
+        if args.id:
+            proj = find_project(args.id)
+            if proj is None:
+                print("Could not find specified project!")
+                return False
+            print(format_budget_entry(proj, totals.get(proj.id, (0, 0))[0]))
+            for day, seconds, entries in store.project_days(proj.id):
+                print("   %s %s (%d entries)" % (day, elapsed_time(seconds) or "0s", entries))
+            return True
+    finally:
+        store.close()
+
+    wsp = None
+    if args.workspace:
+        wsp = find_workspace(args.workspace)
+        if wsp is None:
+            print("Could not find specified workspace!")
+            return False
+
+    out = TogglOutput()
+    out.write("%6s %-40s %12s %14s" % ("Used", "Project", "Estimate", "Actual"))
+    for proj in load_all("projects", toggl.get_projects):
+        if not proj.is_active and not args.show_archived:
+            continue
+        if wsp is not None and proj.workspace is not None and wsp.id != proj.workspace.id:
+            continue
+        out.write(format_budget_entry(proj, totals.get(proj.id, (0, 0))[0]))
+    out.flush()
+    return True
+
 def cmd_project(args):
     if args.add:
         if not args.name or not args.workspace:
@@ -750,13 +2799,13 @@ def cmd_project(args):
                 return False
             p.client = cli
 
-        toggl.add_project(p)
+        write_through_projects(toggl.add_project(p))
     elif args.update:
         if not args.id:
             print("-i is required when updating a project")
             return False
 
-        p = find_project(args.id)
+        p = find_project(args.id, ask=True)
         if p is None:
             print("Could not find specified project!")
             return False
@@ -781,11 +2830,15 @@ def cmd_project(args):
                 return False
             p.client = cli
 
-        toggl.update_project(p)
+        write_through_projects(toggl.update_project(p))
+    elif args.budget:
+        return show_budget(args)
+    elif args.find:
+        return search_projects(args.find)
     elif args.archive:
-        toggl.archive_projects(args.archive)
+        return bulk_project_state(args.archive, toggl.archive_projects, "Archived", args.yes)
     elif args.reopen:
-        toggl.reopen_projects(args.reopen)
+        return bulk_project_state(args.reopen, toggl.reopen_projects, "Reopened", args.yes)
     elif args.id:
         proj = find_project(args.id)
         if proj is None:
@@ -836,7 +2889,7 @@ def cmd_client(args):
                 return False
             c.workspace = wksp
 
-        toggl.add_client(c)
+        write_through_clients(toggl.add_client(c))
 
         return True
     elif args.update:
@@ -861,9 +2914,11 @@ def cmd_client(args):
                 return False
             c.workspace = wksp
 
-        if not toggl.update_client(c):
+        resp = toggl.update_client(c)
+        if not resp.success:
             print("Failed to update specified client!")
             return False
+        write_through_clients(resp)
 
         return True
     elif args.delete:
@@ -871,9 +2926,11 @@ def cmd_client(args):
             print("Must specify the client id to delete!")
             return False
 
-        if not toggl.delete_client(args.id):
-            print("Failed to update specified client!")
+        resp = toggl.delete_client(args.id)
+        if not resp.success:
+            print("Failed to delete specified client!")
             return False
+        write_through_clients(None, removed_ids=[args.id])
 
         return True
     elif args.id:
@@ -896,7 +2953,7 @@ def cmd_task(args):
             print("Project is required for new task entries!")
             return False
 
-        proj = find_project(args.proj)
+        proj = find_project(args.proj, announce=True)
         if not proj:
             print("Unable to find specified project!")
             return False
@@ -932,7 +2989,7 @@ def cmd_task(args):
         if args.estimate is not None:
             t.estimated_seconds = parse_estimate(args.estimate)
         if args.proj is not None:
-            proj = find_project(args.proj)
+            proj = find_project(args.proj, announce=True)
             if not proj:
                 print("Unable to find specified project!")
                 return False
@@ -966,21 +3023,447 @@ def cmd_update(args):
         print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
         return False
 
-    raw = TogglRawData()
-    toggl.get_projects(raw_data=raw)
-    toggl_cache.update_project_cache(raw.response_data)
-
-    raw = TogglRawData()
-    toggl.get_workspaces(raw_data=raw)
-    toggl_cache.update_workspace_cache(raw.response_data)
+    if args.workspace:
+        if not toggl_cache.sharded:
+            print("Set options.shard_by_workspace in ~/.togglrc to update a single workspace.")
+            return False
+        wsp = find_workspace(args.workspace)
+        if wsp is None:
+            print("Could not find specified workspace!")
+            return False
+        wsp_list = [wsp]
+    else:
+        wsp_list = load_collection("workspaces", toggl.get_workspaces, update_cache=True)
 
-    raw = TogglRawData()
-    toggl.get_clients(raw_data=raw)
-    toggl_cache.update_client_cache(raw.response_data)
+    if toggl_cache.sharded:
+        for collection in sorted(SHARDED_COLLECTIONS.keys()):
+            load_shards(collection, wsp_list, update_cache=True)
+    else:
+        load_collection("projects", toggl.get_projects, update_cache=True)
+        load_collection("clients", toggl.get_clients, update_cache=True)
 
     print("Caches updated!")
     return True
 
+def format_cache_stats(collection, counters):
+    lookups = counters.get('hits', 0) + counters.get('misses', 0) + \
+            counters.get('expirations', 0)
+    ratio = 100.0 * counters.get('hits', 0) / lookups if lookups else 0.0
+    loads = counters.get('loads', 0)
+    avg_load = 1000.0 * counters.get('load_time', 0) / loads if loads else 0.0
+    return "%-12s %8d %8d %8d %8d %7.1f%% %12d %12d %10.2f" % (collection,
+            counters.get('hits', 0), counters.get('misses', 0),
+            counters.get('expirations', 0), counters.get('evictions', 0), ratio,
+            counters.get('bytes_read', 0), counters.get('bytes_written', 0),
+            avg_load)
+
+def cmd_cache(args):
+    if args.action == 'reset':
+        toggl_cache.reset_stats()
+        print("Cache statistics reset.")
+        return True
+
+    stats = toggl_cache.stats
+    if args.json:
+        print(json_format(dict((collection, dict((key, counters.get(key, 0))
+            for key in CACHE_STAT_KEYS)) for collection, counters in stats.items())))
+        return True
+
+    print("%-12s %8s %8s %8s %8s %8s %12s %12s %10s" % ("Collection", "Hits",
+        "Misses", "Expired", "Evicted", "Ratio", "Bytes read", "Bytes wrote", "Load (ms)"))
+    for collection in sorted(stats.keys()):
+        print(format_cache_stats(collection, stats[collection]))
+    return True
+
+def iter_range_entries(start_date, end_date, local=False):
+    """Yields the entries starting between the two dates, in start order,
+       from the local store if local is set or else from the API."""
+    if not local:
+        for entry in toggl.iter_time_entries(start_date, end_date):
+            yield entry
+        return
+
+    store = toggl_cache.open_store()
+    try:
+        for entry in store.iter_entries(calendar.timegm(start_date.utctimetuple()),
+                calendar.timegm(end_date.utctimetuple())):
+            yield entry
+    finally:
+        store.close()
+
+def format_timestamp(ts):
+    fmt = get_formatter()
+    return datetime.datetime.fromtimestamp(ts, fmt.tz).strftime(fmt.entry_date_fmt)
+
+def cmd_overlaps(args):
+    """Lists entries whose times overlap, e.g. from forgotten starts."""
+    if args.local and not toggl_cache.enabled:
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+
+    start_date, end_date = time_range(args.start, args.end)
+    index = TogglIntervalIndex(iter_range_entries(start_date, end_date, args.local))
+    fmt = get_formatter()
+    out = TogglOutput()
+    count = 0
+    for entry, other, start, stop in index.overlaps():
+        duplicate = entry.start_time == other.start_time and \
+                entry.stop_time == other.stop_time and entry.desc == other.desc
+        out.write("%s - %s (%s)%s" % (format_timestamp(start), format_timestamp(stop),
+            elapsed_time(int(stop - start)), " duplicate" if duplicate else ""))
+        out.write("   %s" % fmt.entry(entry, verbose=True))
+        out.write("   %s" % fmt.entry(other, verbose=True))
+        count += 1
+    out.write("%d overlapping pairs in %d entries." % (count, len(index)))
+    out.flush()
+    return True
+
+def cmd_at(args):
+    """Shows the entries that were running at the given time."""
+    if args.local and not toggl_cache.enabled:
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+
+    at = date_parser.parse(parse_time_str(args.time))
+    start_date, end_date = time_range(args.start, args.end)
+    if args.start is None:
+        start_date = at - AT_LOOKBACK
+    if args.end is None:
+        end_date = at + datetime.timedelta(seconds=1)
+
+    index = TogglIntervalIndex(iter_range_entries(start_date, end_date, args.local))
+    entries = index.at(calendar.timegm(at.utctimetuple()))
+    if not entries:
+        print("Nothing was running at %s." % args.time)
+        return True
+    fmt = get_formatter()
+    for entry in entries:
+        print(fmt.entry(entry, verbose=True))
+    return True
+
+def cmd_sync(args):
+    """Copies the entries in the given range into the local entry store and
+       drops stored entries in the range that no longer exist."""
+    if not toggl_cache.enabled:
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+
+    start_date, end_date = time_range(args.start, args.end)
+    store = toggl_cache.open_store()
+    try:
+        seen = set()
+        batch = []
+        for entry in toggl.iter_time_entries(start_date, end_date):
+            seen.add(entry.id)
+            batch.append(entry)
+            if len(batch) >= SYNC_BATCH_SIZE:
+                store.upsert(batch)
+                batch = []
+        store.upsert(batch)
+
+        stale = store.ids_between(calendar.timegm(start_date.utctimetuple()),
+                calendar.timegm(end_date.utctimetuple())) - seen
+        store.delete(stale)
+        print("Synced %d entries, removed %d." % (len(seen), len(stale)))
+    finally:
+        store.close()
+    return True
+
+EXPORT_COLUMNS = ['id', 'start', 'stop', 'duration', 'description', 'billable',
+    'project_id', 'project', 'client_id', 'client', 'workspace_id', 'workspace']
+EXPORT_CHUNK_SIZE = 2000
+# Chunks formatted in-process before handing the rest to worker processes.
+EXPORT_INLINE_CHUNKS = 5
+SYNC_BATCH_SIZE = 500
+# How far back 'toggl at' looks for entries that were still running.
+AT_LOOKBACK = datetime.timedelta(days=7)
+
+class TogglNameResolver:
+    """Maps project, client and workspace ids to names using the caches."""
+
+    def __init__(self):
+        self.projects = {}
+        self.project_clients = {}
+        for proj in load_all("projects", toggl.get_projects):
+            self.projects[proj.id] = proj.name
+            client = proj.fields.get(KEY_CLIENT)
+            if isinstance(client, dict):
+                self.project_clients[proj.id] = client.get(KEY_ID)
+            elif proj.fields.get('cid'):
+                self.project_clients[proj.id] = proj.fields.get('cid')
+        self.clients = dict((c.id, c.name) for c in load_all("clients", toggl.get_clients))
+        self.workspaces = dict((w.id, w.name) for w in load_collection("workspaces", toggl.get_workspaces))
+
+    def row(self, entry):
+        """Returns the export row for an entry as a list of EXPORT_COLUMNS."""
+        fields = entry.fields
+        proj_id = entry_project_id(fields)
+        client_id = self.project_clients.get(proj_id)
+        wsp_id = workspace_of(fields)
+        return [entry.id, entry.start_time, fields.get(KEY_STOP),
+                entry.duration, fields.get(KEY_DESC),
+                bool(fields.get(KEY_BILLABLE)), proj_id,
+                self.projects.get(proj_id), client_id,
+                self.clients.get(client_id), wsp_id,
+                self.workspaces.get(wsp_id)]
+
+def format_export_rows(fmt, rows):
+    """Renders rows as CSV or JSON lines text. Runs in worker processes, so
+       it must not depend on the module's globals."""
+    if fmt == 'jsonl':
+        return ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+    buf = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    csv.writer(buf, lineterminator='\n').writerows(rows)
+    return buf.getvalue()
+
+def positive_int(text):
+    """argparse type for counts that must be at least 1."""
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError("expected a whole number of at least 1, got '%s'" % text)
+    return value
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def export_text(fmt, chunks, out, jobs):
+    """Writes the formatted chunks in order. Once the export proves large,
+       formatting moves to a process pool with a bounded number of chunks in
+       flight, so memory stays flat however many entries there are."""
+    if fmt == 'csv':
+        out.write(format_export_rows(fmt, [EXPORT_COLUMNS]))
+    pool = None
+    pending = []
+    try:
+        for n, chunk in enumerate(chunks):
+            if pool is None and jobs != 1 and n >= EXPORT_INLINE_CHUNKS:
+                pool = multiprocessing.Pool(jobs)
+            if pool is None:
+                out.write(format_export_rows(fmt, chunk))
+                continue
+            pending.append(pool.apply_async(format_export_rows, (fmt, chunk)))
+            while len(pending) > 2 * (jobs or multiprocessing.cpu_count()):
+                out.write(pending.pop(0).get())
+        for result in pending:
+            out.write(result.get())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def export_parquet(chunks, path):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print("The parquet format requires the pyarrow module.")
+        return False
+
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pyarrow.Table.from_pydict(dict(
+                (name, [row[i] for row in chunk]) for i, name in enumerate(EXPORT_COLUMNS)))
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return True
+
+def cmd_export(args):
+    """Exports the time entries in a range with resolved names."""
+    start_date, end_date = time_range(args.start, args.end)
+    if args.format == 'parquet' and not args.output:
+        print("-o is required for the parquet format.")
+        return False
+
+    if args.local and not toggl_cache.enabled:
+        print("Caching is not enabled. Set options.cache_enabled in ~/.togglrc to enable it.")
+        return False
+
+    resolver = TogglNameResolver()
+    entries = iter_range_entries(start_date, end_date, args.local)
+    chunks = iter_chunks((resolver.row(e) for e in entries), EXPORT_CHUNK_SIZE)
+    if args.format == 'parquet':
+        return export_parquet(chunks, args.output)
+
+    if args.output:
+        out = io.open(args.output, 'w', encoding='utf-8', newline='')
+    else:
+        out = sys.stdout
+    try:
+        export_text(args.format, chunks, out, args.jobs)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return True
+
+def report_totals(rows, fmt):
+    """Sums report rows into per-user, per-user-and-project and per-day
+       totals, in seconds."""
+    totals = {'user': {}, 'project': {}, 'day': {}}
+    for row in rows:
+        user = row.user_id
+        proj = row.project or '(No Project)'
+        day = fmt.day(row)
+        totals['user'][user] = totals['user'].get(user, 0) + row.duration
+        key = (user, proj)
+        totals['project'][key] = totals['project'].get(key, 0) + row.duration
+        totals['day'][day] = totals['day'].get(day, 0) + row.duration
+    return totals
+
+def merge_totals(parts):
+    merged = {'user': {}, 'project': {}, 'day': {}}
+    for part in parts:
+        for kind, sums in part.items():
+            for key, val in sums.items():
+                merged[kind][key] = merged[kind].get(key, 0) + val
+    return merged
+
+def cmd_report(args):
+    """Reports the time of several workspace users, fetching each user's
+       entries concurrently."""
+    wsp = find_workspace(args.workspace)
+    if wsp is None:
+        print("Could not find specified workspace!")
+        return False
+
+    users = toggl.get_workspace_users(wsp.id)
+    if not args.all_users:
+        if not args.user:
+            print("Specify users with -u or use --all-users.")
+            return False
+        wanted = set(args.user)
+        users = [u for u in users if str(u.id) in wanted or u.email in wanted or u.fullname in wanted]
+        if not users:
+            print("Could not find the specified users!")
+            return False
+
+    # The reports API takes local dates; time_range may return UTC times.
+    fmt = get_formatter()
+    start_date, end_date = time_range(args.start, args.end)
+    since = start_date.astimezone(fmt.tz).date().isoformat()
+    until = end_date.astimezone(fmt.tz).date().isoformat()
+
+    totals = merge_totals(parallel_map(lambda user: report_totals(
+        toggl.iter_report_details(wsp.id, since, until, [user.id]), fmt), users))
+
+    out = TogglOutput()
+    for user in sorted(users, key=lambda u: -totals['user'].get(u.id, 0)):
+        out.write("%s <%s> (%s)" % (user.fullname, user.email,
+            elapsed_time(totals['user'].get(user.id, 0))))
+        projs = [(proj, secs) for (uid, proj), secs in totals['project'].items() if uid == user.id]
+        for proj, secs in sorted(projs, key=lambda p: -p[1]):
+            out.write("   @%s (%s)" % (proj, elapsed_time(secs)))
+    out.write("Per day:")
+    for day in sorted(totals['day'].keys()):
+        out.write("   %s (%s)" % (day, elapsed_time(totals['day'][day])))
+    out.write("Total time: %s" % elapsed_time(sum(totals['user'].values())))
+    out.flush()
+    return True
+
+# Value completion: (subcommands, short and long option, list name).
+COMPLETION_VALUES = [
+    (['add', 'edit', 'start', 'task'], '-p', '--proj', 'projects'),
+    (['proj', 'client', 'update', 'report'], '-w', '--workspace', 'workspaces'),
+    (['proj'], '-c', '--client', 'clients'),
+    (['proj'], '-i', '--id', 'projects'),
+    (['client'], '-i', '--id', 'clients'),
+    (['wksp'], '-i', '--id', 'workspaces'),
+    (['edit', 'rm'], '-i', '--id', 'entries'),
+]
+
+BASH_COMPLETION = """_toggl_list() {
+    # Prints the cached completion lists named $2 of kind $1.
+    cat "%(dir)s/$1/$2" "%(dir)s/$1/$2".* 2>/dev/null
+}
+
+_toggl_aliases() {
+    sed -n '/^\\[aliases\\]/,/^\\[/s/^\\(@[^=]*\\)=.*/\\1/p' ~/.togglrc 2>/dev/null
+}
+
+_toggl() {
+    local cur prev cmd words IFS=$'\\n'
+    cur="${COMP_WORDS[COMP_CWORD]}"
+    prev="${COMP_WORDS[COMP_CWORD-1]}"
+    cmd="${COMP_WORDS[1]}"
+    COMPREPLY=()
+    if [ "$COMP_CWORD" -eq 1 ]; then
+        COMPREPLY=($(compgen -W "%(commands)s" -- "$cur"))
+        return
+    fi
+    case "$cmd $prev" in
+%(cases)s
+        *) return ;;
+    esac
+    COMPREPLY=($(compgen -W "$words" -- "$cur" | while read -r w; do printf '%%q\\n' "$w"; done))
+}
+complete -F _toggl toggl
+"""
+
+ZSH_COMPLETION = """autoload -U +X bashcompinit && bashcompinit
+%(bash)s"""
+
+FISH_COMPLETION = """function __toggl_list
+    cat %(dir)s/$argv[1]/$argv[2] %(dir)s/$argv[1]/$argv[2].* 2>/dev/null
+end
+
+function __toggl_aliases
+    sed -n '/^\\[aliases\\]/,/^\\[/s/^\\(@[^=]*\\)=.*/\\1/p' ~/.togglrc 2>/dev/null
+end
+
+complete -c toggl -f
+complete -c toggl -n '__fish_use_subcommand' -a '%(commands)s'
+%(lines)s
+"""
+
+def completion_words(kind):
+    """Shell snippet producing the candidates for a value list."""
+    if kind == 'entries':
+        return "_toggl_list ids entries"
+    if kind == 'projects':
+        return "_toggl_list names projects; _toggl_list ids projects; _toggl_aliases"
+    return "_toggl_list names %s; _toggl_list ids %s" % (kind, kind)
+
+def cmd_completion(args):
+    """Prints a completion script that reads the lists kept next to the
+       caches, so completing never starts Python."""
+    directory = "%s/%s" % (toggl_cache.path, COMPLETION_DIR)
+    commands = ' '.join(args.subcommands)
+    if args.shell == 'fish':
+        lines = []
+        for cmds, short, long_opt, kind in COMPLETION_VALUES:
+            source = completion_words(kind).replace('_toggl_', '__toggl_')
+            lines.append("complete -c toggl -n '__fish_seen_subcommand_from %s' -s %s -l %s -x -a '(%s)'" %
+                    (' '.join(cmds), short[1:], long_opt[2:], source))
+        print(FISH_COMPLETION % {'dir': directory, 'commands': commands, 'lines': '\n'.join(lines)})
+        return True
+
+    cases = []
+    for cmds, short, long_opt, kind in COMPLETION_VALUES:
+        patterns = '|'.join('"%s %s"|"%s %s"' % (c, short, c, long_opt) for c in cmds)
+        cases.append('        %s) words="$(%s)" ;;' % (patterns, completion_words(kind)))
+    # compgen splits on IFS, which the script sets to newlines.
+    bash = BASH_COMPLETION % {'dir': directory, 'commands': '\n'.join(args.subcommands),
+            'cases': '\n'.join(cases)}
+    if args.shell == 'zsh':
+        print(ZSH_COMPLETION % {'bash': bash})
+    else:
+        print(bash)
+    return True
+
 def visit_web(args):
     if not toggl_cfg.has_option('options', 'web_browser_cmd'):
         print("Please set the web_browser_cmd setting in the options section of your ~/.togglrc")
@@ -1005,14 +3488,25 @@ def create_default_cfg():
         cfg.write(cfgfile)
 
 def find_alias_key_by_val(sval):
-    for key, val in alias_dict.items():
-        if val == sval:
-            return key
-    return None
+    return alias_rev_dict.get(sval)
 
 def build_alias_table():
     for pair in toggl_cfg.items('aliases'):
         alias_dict[pair[0]] = pair[1]
+        # The first alias of a project is the one displayed.
+        alias_rev_dict.setdefault(pair[1], pair[0])
+
+def reset_run_state():
+    """Forgets what an earlier main() in this process worked out from its
+       config and caches, so that each run, e.g. of a benchmark running
+       toggl in-process, starts from the same cold state."""
+    global _fuzzy_index, _formatter, _memprofile
+    _fuzzy_index = None
+    _formatter = None
+    _memprofile = None
+    _elapsed_parts.clear()
+    alias_dict.clear()
+    alias_rev_dict.clear()
 
 def init_config():
     global toggl_cfg
@@ -1032,6 +3526,85 @@ def init_config():
 
     return True
 
+PROFILE_SECTION_PREFIX = 'profile '
+
+def profile_names():
+    """Returns the names of the [profile NAME] sections, in sorted order."""
+    return sorted(s[len(PROFILE_SECTION_PREFIX):] for s in toggl_cfg.sections()
+            if s.startswith(PROFILE_SECTION_PREFIX))
+
+def select_profile(name):
+    """Makes a [profile NAME] section the active account. Its username and
+       password replace [auth]; any other keys override [options]. Unless
+       the profile sets cache_path, it gets its own cache under the default
+       one, so accounts never share cached projects or entries."""
+    section = PROFILE_SECTION_PREFIX + name
+    if not toggl_cfg.has_section(section):
+        print("No [%s] section in ~/.togglrc!" % section)
+        return False
+    base_cache_path = DEFAULT_CACHE_PATH
+    if toggl_cfg.has_option('options', 'cache_path'):
+        base_cache_path = toggl_cfg.get('options', 'cache_path')
+    toggl_cfg.set('options', 'cache_path', os.path.join(base_cache_path, 'profiles', name))
+    if not toggl_cfg.has_section('auth'):
+        toggl_cfg.add_section('auth')
+    for key, val in toggl_cfg.items(section):
+        toggl_cfg.set('auth' if key in ('username', 'password') else 'options', key, val)
+    return True
+
+def run_profile(job):
+    """Runs a command line against one profile; called in a worker process
+       by run_all_profiles. Returns (profile, success, captured stdout)."""
+    name, argv = job
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    sys.argv = ['toggl', '--profile', name] + argv
+    try:
+        status = main()
+    except Exception as e:
+        print("Error: %s" % e)
+        status = 1
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = stdout
+    return name, status == 0, output
+
+def run_all_profiles(args):
+    """Runs the command against every profile at once, one process per
+       profile so that each account keeps its own cache, scheduler and rate
+       limit, then prints the outputs one profile after another with each
+       line labelled by profile. Totals stay per profile."""
+    if args.profile is not None:
+        print("--profile and --profile-all cannot be combined.")
+        return False
+    names = profile_names()
+    if not names:
+        print("No [profile NAME] sections in ~/.togglrc!")
+        return False
+    if args.func not in (list_time_entries, cmd_report, cmd_update) or \
+            getattr(args, 'watch', False):
+        print("--profile-all works with ls (without -w), report and update.")
+        return False
+    argv = [a for a in sys.argv[1:] if a != '--profile-all']
+    # A fresh process per profile, so no state carries over between accounts.
+    pool = multiprocessing.Pool(len(names), maxtasksperchild=1)
+    try:
+        results = pool.map(run_profile, [(name, argv) for name in names])
+    finally:
+        pool.close()
+        pool.join()
+
+    width = max(len(name) for name in names)
+    out = TogglOutput()
+    for name, success, output in results:
+        label = "%-*s " % (width, name)
+        for line in output.splitlines():
+            out.write(label + line)
+        if not success:
+            out.write(label + "(failed)")
+    out.flush()
+    return all(success for name, success, output in results)
+
 def init_cache():
     global toggl_cache
     cache_enabled = False
@@ -1043,23 +3616,194 @@ def init_cache():
     max_cache_age = 0
     if toggl_cfg.has_option('options', 'max_cache_age_days'):
         max_cache_age = toggl_cfg.get('options', 'max_cache_age_days')
+    # Per-collection TTLs, e.g. projects_cache_age_days=1
+    collection_ages = {}
+    for collection in CACHE_COLLECTIONS:
+        option = '%s_cache_age_days' % collection
+        if toggl_cfg.has_option('options', option):
+            collection_ages[collection] = toggl_cfg.getfloat('options', option)
+    max_cache_size = 0
+    if toggl_cfg.has_option('options', 'max_cache_size_kb'):
+        max_cache_size = toggl_cfg.get('options', 'max_cache_size_kb')
+    sharded = False
+    if toggl_cfg.has_option('options', 'shard_by_workspace'):
+        sharded = toggl_cfg.getboolean('options', 'shard_by_workspace')
     toggl_cache = TogglCache(cache_path=cache_path,
-            cache_enabled=cache_enabled, max_age_days=float(max_cache_age))
+            cache_enabled=cache_enabled, max_age_days=float(max_cache_age),
+            collection_ages=collection_ages, max_size_kb=float(max_cache_size),
+            sharded=sharded)
 
     return True
 
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+METRIC_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][\w:]*)(\{.*\})? (\S+)$')
+# Metric families written to the OpenMetrics file: (name, type, help, sample
+# name suffixes).
+METRIC_FAMILIES = [
+    ('toggl_api_requests', 'counter', 'API requests by method, endpoint and status.', ['_total']),
+    ('toggl_api_errors', 'counter', 'API requests that failed with an error status or no response.', ['_total']),
+    ('toggl_api_retries', 'counter', 'Retried attempts of API requests.', ['_total']),
+    ('toggl_api_request_bytes', 'counter', 'Bytes sent in API request bodies.', ['_total']),
+    ('toggl_api_response_bytes', 'counter', 'Bytes received in API responses.', ['_total']),
+    ('toggl_api_request_duration_seconds', 'histogram',
+        'API request latency, including retries.', ['_bucket', '_sum', '_count']),
+]
+
+LE_LABEL_RE = re.compile(r',?le="([^"]*)"')
+
+def metric_sort_key(key, names):
+    """Orders samples so each label set's samples stay together, with
+       histogram buckets by increasing bound, as OpenMetrics requires."""
+    name, labels = key.split('{', 1)
+    m = LE_LABEL_RE.search(labels)
+    le = float(m.group(1).replace('+Inf', 'inf')) if m else 0
+    return (LE_LABEL_RE.sub('', labels), names.index(name), le)
+
+def metric_key(name, labels):
+    return "%s{%s}" % (name, ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+        .replace('"', '\\"')) for k, v in labels))
+
+class TogglTracer:
+    """Scheduler hook recording API requests: each one as a line of a
+       JSON-lines trace file, and all of them as counters and a latency
+       histogram added to an OpenMetrics text file, e.g. for the node
+       exporter's textfile collector."""
+
+    def __init__(self, trace_path=None, metrics_path=None, command=None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.command = command
+        self.samples = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._trace = open(os.path.expanduser(trace_path), "a") if trace_path else None
+
+    def _add(self, name, labels, value):
+        key = metric_key(name, labels)
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    def __call__(self, event):
+        with self._lock:
+            if self._trace is not None:
+                record = dict(event, command=self.command)
+                self._trace.write(json.dumps(record, sort_keys=True) + "\n")
+                self._trace.flush()
+            labels = [('method', event['method']), ('endpoint', event['endpoint'])]
+            status = event['status'] if event['status'] is not None else event['error']
+            self._add('toggl_api_requests_total', labels + [('status', status)], 1)
+            if event['status'] is None or event['status'] >= 400:
+                self._add('toggl_api_errors_total', labels, 1)
+            self._add('toggl_api_retries_total', labels, event['retries'])
+            self._add('toggl_api_request_bytes_total', labels, event['request_bytes'])
+            self._add('toggl_api_response_bytes_total', labels, event['response_bytes'] or 0)
+            # Every bucket is written, zero or not, so each label set has a
+            # complete histogram.
+            for bound in LATENCY_BUCKETS:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                self._add('toggl_api_request_duration_seconds_bucket', labels + [('le', le)],
+                        1 if event['latency'] <= bound else 0)
+            self._add('toggl_api_request_duration_seconds_sum', labels, event['latency'])
+            self._add('toggl_api_request_duration_seconds_count', labels, 1)
+
+    def _read_metrics(self, path):
+        samples = collections.OrderedDict()
+        try:
+            f = open(path, "r")
+        except IOError:
+            return samples
+        for line in f:
+            m = METRIC_SAMPLE_RE.match(line.strip())
+            if m:
+                samples[m.group(1) + (m.group(2) or '')] = float(m.group(3))
+        f.close()
+        return samples
+
+    def write_metrics(self):
+        """Adds this run's samples to those already in the metrics file, so
+           the counters keep growing across runs, and rewrites it atomically.
+           Concurrent runs take turns where file locks are available."""
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+        if not self.metrics_path or not self.samples:
+            return
+        path = os.path.expanduser(self.metrics_path)
+        lock = open(path + ".lock", "a")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            samples = self._read_metrics(path)
+            for key, value in self.samples.items():
+                samples[key] = samples.get(key, 0) + value
+            lines = []
+            for family, kind, text, suffixes in METRIC_FAMILIES:
+                names = [family + suffix for suffix in suffixes]
+                keys = [k for k in samples if k.split('{')[0] in names]
+                if not keys:
+                    continue
+                lines.append("# TYPE %s %s" % (family, kind))
+                lines.append("# HELP %s %s" % (family, text))
+                keys.sort(key=lambda k: metric_sort_key(k, names))
+                lines.extend("%s %s" % (k, repr(float(samples[k]))) for k in keys)
+            lines.append("# EOF")
+            f = open(path + ".tmp", "w")
+            f.write("\n".join(lines) + "\n")
+            f.close()
+            os.rename(path + ".tmp", path)
+        finally:
+            lock.close()
+
+def init_tracer(args, scheduler):
+    """Adds a TogglTracer to the scheduler if --trace/--metrics or the
+       trace_file/metrics_file options ask for one."""
+    paths = []
+    for arg, option in [(args.trace, 'trace_file'), (args.metrics, 'metrics_file')]:
+        if arg is None and toggl_cfg.has_option('options', option):
+            arg = toggl_cfg.get('options', option)
+        paths.append(arg)
+    if not any(paths):
+        return None
+    tracer = TogglTracer(paths[0], paths[1], getattr(args.func, '__name__', None))
+    scheduler.hooks.append(tracer)
+    return tracer
+
+def init_transport(args):
+    """Builds the HTTP transport selected by --record, --replay and
+       --latency."""
+    latency = args.latency / 1000.0
+    if args.replay:
+        return TogglReplayTransport(args.replay, latency)
+    if args.record:
+        return TogglRecordingTransport(args.record, latency)
+    return TogglTransport(latency)
+
+def init_scheduler(transport=None):
+    """Builds the request scheduler from the api_* options."""
+    kwargs = {'transport': transport}
+    for option, key, conv in [('api_rate', 'rate', float),
+            ('api_burst', 'burst', int),
+            ('api_max_concurrent', 'max_concurrent', int),
+            ('api_max_retries', 'max_retries', int)]:
+        if toggl_cfg.has_option('options', option):
+            kwargs[key] = conv(toggl_cfg.get('options', option))
+    return TogglScheduler(**kwargs)
+
 def main():
     """Program entry point."""
     
-    if not init_config() or not init_cache():
+    reset_run_state()
+    if not init_config():
         return 1
 
-    global IGNORE_START_TIMES
-    auth = (toggl_cfg.get('auth', 'username').strip(), toggl_cfg.get('auth', 'password').strip())
-    IGNORE_START_TIMES = toggl_cfg.getboolean('options', 'ignore_start_times')
-
     parser = argparse.ArgumentParser(prog='toggl')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
+    parser.add_argument('-P', '--profile', help='Use the account of a [profile NAME] section of ~/.togglrc', default=None, metavar='NAME')
+    parser.add_argument('--profile-all', help="Run ls, report or update against every profile at once, printing each profile's output in turn", action='store_true', default=False)
+    parser.add_argument('--record', help='Append every API request and response to a cassette file (responses are read in full, so ls no longer streams)', default=None, metavar='FILE')
+    parser.add_argument('--replay', help='Answer API requests from a cassette file instead of the network', default=None, metavar='FILE')
+    parser.add_argument('--trace', help='Append a JSON line per API request to FILE', default=None, metavar='FILE')
+    parser.add_argument('--metrics', help='Add API request metrics to an OpenMetrics text file', default=None, metavar='FILE')
+    parser.add_argument('--memprofile', help='Report peak memory and the top allocation sites on stderr, by stage for ls', action='store_true', default=False)
+    parser.add_argument('--latency', help='Delay each API request by this many milliseconds', type=float, default=0, metavar='MS')
 
     subparsers = parser.add_subparsers(help='sub-command help')
 
@@ -1068,6 +3812,9 @@ def main():
     parser_ls.add_argument('-s', '--start', help='Specify start date', default=None)
     parser_ls.add_argument('-e', '--end', help='Specify end date', default=None)
     parser_ls.add_argument('-g', '--grep', help='Find time entry descriptions matching this regex', default=None)
+    parser_ls.add_argument('-f', '--filter', help="Only list entries matching a filter, e.g. 'project:web !billable dur>1h weekday:mon-fri time:09:00-12:00 desc~review'", default=None, metavar='EXPR')
+    parser_ls.add_argument('-w', '--watch', help='Keep the list on screen, updated live', action='store_true', default=False)
+    parser_ls.add_argument('-l', '--local', help="List entries from the local store filled by 'toggl sync'", action='store_true', default=False)
     parser_ls.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_ls.add_argument('-q', '--quiet', help='Do not show entries, only sums', action='store_true', default=False)
     parser_ls.add_argument('-S', '--sum', help='Show time summary', action='store_true', default=False)
@@ -1082,17 +3829,22 @@ def main():
     parser_add.set_defaults(func=add_time_entry)
 
     parser_edit = subparsers.add_parser('edit', help='Edit an existing time entry')
-    parser_edit.add_argument('-i', '--id', help='The time entry id to edit', required=True)
+    parser_edit.add_argument('-i', '--id', help='The time entry id to edit', default=None)
     parser_edit.add_argument('-m', '--msg', help='Log entry message')
     parser_edit.add_argument('-p', '--proj', help='Project for the log entry')
     parser_edit.add_argument('-d', '--duration', help='Entry duration')
-    parser_edit.add_argument('-s', '--start', help='Specify start date', default=None)
-    parser_edit.add_argument('-e', '--end', help='Specify end date', default=None)
+    parser_edit.add_argument('-s', '--start', help='Specify start date (with --grep: start of the range searched)', default=None)
+    parser_edit.add_argument('-e', '--end', help='Specify end date (with --grep: end of the range searched)', default=None)
     parser_edit.add_argument('-c', '--calc-duration', help='Calculate duration from start/end dates', action='store_true', default=False)
+    parser_edit.add_argument('-g', '--grep', help='Edit every entry whose description matches this regex', default=None)
+    parser_edit.add_argument('-n', '--dry-run', help='Only show what --grep would change', action='store_true', default=False)
+    parser_edit.add_argument('-y', '--yes', help='Apply --grep changes without asking', action='store_true', default=False)
+    parser_edit.add_argument('-r', '--resume', help='Skip entries finished by an interrupted --grep run', action='store_true', default=False)
     parser_edit.set_defaults(func=edit_time_entry)
 
     parser_now = subparsers.add_parser('now', help='Show the current time entry')
     parser_now.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
+    parser_now.add_argument('-w', '--watch', help="Keep the running entry and today's total on screen, updated live", action='store_true', default=False)
     parser_now.set_defaults(func=list_current_time_entry)
 
     parser_proj = subparsers.add_parser('proj', help='Manage projects')
@@ -1100,8 +3852,9 @@ def main():
     parser_proj.add_argument('-A', '--show-archived', help="Override the show-archived setting", action='store_true', default=None)
     parser_proj.add_argument('-a', '--add', help="Add a new project entry", action='store_true', default=False)
     parser_proj.add_argument('-u', '--update', help="Update an existing project entry", action='store_true', default=False)
-    parser_proj.add_argument('-r', '--archive', help="Archive a project entry", default=None, metavar='IDLIST')
-    parser_proj.add_argument('-o', '--reopen', help="Reopen an archived project entry", default=None, metavar='IDLIST')
+    parser_proj.add_argument('-r', '--archive', help="Archive projects by id, range, name or wildcard pattern, or - for stdin", default=None, metavar='IDLIST')
+    parser_proj.add_argument('-o', '--reopen', help="Reopen archived projects by id, range, name or wildcard pattern, or - for stdin", default=None, metavar='IDLIST')
+    parser_proj.add_argument('-y', '--yes', help="Archive or reopen many projects without asking", action='store_true', default=False)
     parser_proj.add_argument('-b', '--billable', help="Set the project's billable value", type=bool, default=None, choices=[True, False])
     parser_proj.add_argument('-n', '--name', help="Set the project's name", default=None)
     parser_proj.add_argument('-i', '--id', help="Specify the project id", default=None)
@@ -1109,6 +3862,8 @@ def main():
     parser_proj.add_argument('-w', '--workspace', help="Set the project's workspace", default=None, metavar='NAME/ID')
     parser_proj.add_argument('-e', '--estimated-workhours', help="Set the project's estimated work hours", type=int, default=None)
     parser_proj.add_argument('-C', '--auto-calc', help="Automatically calculate estimated work hours", type=bool, default=None)
+    parser_proj.add_argument('-f', '--find', help="Rank projects by a fuzzy match on project, client and workspace names", default=None, metavar='QUERY')
+    parser_proj.add_argument('-B', '--budget', help="Compare estimated and logged hours (needs 'toggl sync')", action='store_true', default=False)
     parser_proj.add_argument('-U', '--update-cache', help="Update the project cache", action='store_true', default=False)
     parser_proj.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_proj.set_defaults(func=cmd_project)
@@ -1127,7 +3882,9 @@ def main():
     parser_www.set_defaults(func=visit_web)
 
     parser_rm = subparsers.add_parser('rm', help='Remove a time entry')
-    parser_rm.add_argument('-i', '--id', help='The id to remove', required=True)
+    parser_rm.add_argument('-i', '--id', help='The ids to remove, e.g. 1,2,5-9, or - to read them from stdin', required=True, metavar='IDLIST')
+    parser_rm.add_argument('-n', '--dry-run', help='Only list the ids that would be removed', action='store_true', default=False)
+    parser_rm.add_argument('-y', '--yes', help='Remove many entries without asking', action='store_true', default=False)
     parser_rm.set_defaults(func=delete_time_entry)
 
     parser_wspace = subparsers.add_parser('wksp', help='List workspaces')
@@ -1147,7 +3904,7 @@ def main():
     parser_clients.add_argument('-n', '--name', help="Set the clients's name", default=None)
     parser_clients.add_argument('-c', '--currency', help='Set the currency', default=None)
     parser_clients.add_argument('-r', '--rate', help='Set the hourly rate', default=None)
-    parser_clients.add_argument('-w', '--workspace', help='Set the workspace for this client', default=None)
+    parser_clients.add_argument('-w', '--workspace', help='Set the workspace for this client, or list only its clients', default=None)
     parser_clients.add_argument('-U', '--update-cache', help="Update the workspace cache", action='store_true', default=False)
     parser_clients.add_argument('-v', '--verbose-list', help='Show verbose output', action='store_true', default=False)
     parser_clients.set_defaults(func=cmd_client)
@@ -1168,14 +3925,92 @@ def main():
     parser_tasks.set_defaults(func=cmd_task)
 
     parser_update = subparsers.add_parser('update', help='Update caches')
+    parser_update.add_argument('-w', '--workspace', help='Only update the caches of this workspace', default=None, metavar='NAME/ID')
     parser_update.set_defaults(func=cmd_update)
 
+    parser_report = subparsers.add_parser('report', help='Report the time of workspace users')
+    parser_report.add_argument('-w', '--workspace', help='The workspace to report on', required=True, metavar='NAME/ID')
+    parser_report.add_argument('-a', '--all-users', help='Report on every user of the workspace', action='store_true', default=False)
+    parser_report.add_argument('-u', '--user', help='Report on this user (id, email or full name); repeatable', action='append', default=None)
+    parser_report.add_argument('-s', '--start', help='Specify start date', default=None)
+    parser_report.add_argument('-e', '--end', help='Specify end date', default=None)
+    parser_report.set_defaults(func=cmd_report)
+
+    parser_overlaps = subparsers.add_parser('overlaps', help='List overlapping time entries')
+    parser_overlaps.add_argument('-s', '--start', help='Specify start date', default=None)
+    parser_overlaps.add_argument('-e', '--end', help='Specify end date', default=None)
+    parser_overlaps.add_argument('-l', '--local', help='Use the local store instead of the API', action='store_true', default=False)
+    parser_overlaps.set_defaults(func=cmd_overlaps)
+
+    parser_at = subparsers.add_parser('at', help='Show what was running at a given time')
+    parser_at.add_argument('time', help='The date and time to look at')
+    parser_at.add_argument('-s', '--start', help='Only consider entries starting after this date (default: a week before)', default=None)
+    parser_at.add_argument('-e', '--end', help='Only consider entries starting before this date', default=None)
+    parser_at.add_argument('-l', '--local', help='Use the local store instead of the API', action='store_true', default=False)
+    parser_at.set_defaults(func=cmd_at)
+
+    parser_sync = subparsers.add_parser('sync', help='Copy time entries into the local store')
+    parser_sync.add_argument('-s', '--start', help='Specify start date', default=None)
+    parser_sync.add_argument('-e', '--end', help='Specify end date', default=None)
+    parser_sync.set_defaults(func=cmd_sync)
+
+    parser_export = subparsers.add_parser('export', help='Export time entries')
+    parser_export.add_argument('-f', '--format', help='Output format', choices=['csv', 'jsonl', 'parquet'], default='csv')
+    parser_export.add_argument('-o', '--output', help='Output file (default: stdout)', default=None)
+    parser_export.add_argument('-s', '--start', help='Specify start date', default=None)
+    parser_export.add_argument('-e', '--end', help='Specify end date', default=None)
+    parser_export.add_argument('-l', '--local', help='Export from the local store instead of the API', action='store_true', default=False)
+    parser_export.add_argument('-j', '--jobs', help='Formatting processes for large exports (default: one per CPU)', type=positive_int, default=None)
+    parser_export.set_defaults(func=cmd_export)
+
+    parser_completion = subparsers.add_parser('completion', help='Print a shell completion script')
+    parser_completion.add_argument('shell', help='eval "$(toggl completion bash)" or save the output where your shell loads completions', choices=['bash', 'zsh', 'fish'])
+    parser_completion.set_defaults(func=cmd_completion)
+
+    parser_cache = subparsers.add_parser('cache', help='Show cache statistics')
+    parser_cache.add_argument('action', help='Show or reset the cache statistics', choices=['stats', 'reset'], nargs='?', default='stats')
+    parser_cache.add_argument('-j', '--json', help='Print the statistics as JSON', action='store_true', default=False)
+    parser_cache.set_defaults(func=cmd_cache)
+
+    parser_completion.set_defaults(subcommands=sorted(subparsers.choices.keys()))
+
     global args
     args = parser.parse_args(sys.argv[1:])
+
+    if args.profile_all:
+        return 0 if run_all_profiles(args) else 1
+    if args.profile is not None and not select_profile(args.profile):
+        return 1
+    if not init_cache():
+        return 1
+
+    global IGNORE_START_TIMES
+    auth = (toggl_cfg.get('auth', 'username').strip(), toggl_cfg.get('auth', 'password').strip())
+    IGNORE_START_TIMES = toggl_cfg.getboolean('options', 'ignore_start_times')
+
+    if not init_memprofile(args):
+        return 1
+    transport = init_transport(args)
+    scheduler = init_scheduler(transport)
+    tracer = init_tracer(args, scheduler)
     global toggl
-    toggl = TogglApi(url=TOGGL_URL, auth=auth, verbose=args.verbose)
+    toggl = TogglApi(url=TOGGL_URL, auth=auth, verbose=args.verbose,
+            scheduler=scheduler, reports_url=TOGGL_REPORTS_URL)
 
-    if args.func(args):
+    try:
+        result = args.func(args)
+    except TogglReplayMiss as e:
+        print(e)
+        result = False
+    finally:
+        toggl_cache.save_stats()
+        if tracer is not None:
+            tracer.write_metrics()
+        if _memprofile is not None:
+            _memprofile.report()
+        transport.close()
+
+    if result:
         return 0
     else:
         return 1
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+togglbench.py
+
+Times toggl.py commands against generated accounts of growing size, to
+show how each scales. One sweep grows the number of time entries with the
+projects fixed, the other grows the projects with the entries fixed.
+Each command runs in-process, with a cache enabled, against a togglgen.py
+server in a child process, and the best of --repeat runs is kept. One
+further run of each command is made under tracemalloc to record its peak
+Python heap, which is left out of the timings since tracing slows
+everything down. The server being in another process keeps its memory out
+of that figure.
+
+    togglbench.py --entries 1000,10000,100000,1000000 --projects 10,1000,50000
+                  --csv results.csv --plot scaling.png
+
+The scaling exponent between neighbouring sizes is printed for each command;
+one well above 1 marks a superlinear code path. Plotting needs matplotlib.
+"""
+
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import togglgen
+import toggl
+
+COMMANDS = ['update', 'proj', 'find_project', 'ls', 'ls -p -S']
+# Exponents above this are reported as superlinear.
+SUPERLINEAR = 1.2
+
+BENCH_TOGGLRC = """[auth]
+username=bench
+password=api_token
+
+[options]
+ignore_start_times=False
+timezone=UTC
+web_browser_cmd=true
+datefmt=%%Y-%%m-%%d (%%A)
+entry_datefmt=%%Y-%%m-%%d %%H:%%M%%p
+use_mandays=False
+show_archived_projects=False
+cache_enabled=True
+cache_path=%s
+api_rate=100000
+api_burst=100000
+api_max_concurrent=8
+"""
+
+def command_args(command, start, end, project_name):
+    if command == 'find_project':
+        return ['proj', '-i', project_name]
+    if command.startswith('ls'):
+        return command.split() + ['-s', str(start), '-e', str(end)]
+    return [command]
+
+def run_toggl(argv):
+    """Runs toggl.py in-process with its output discarded and returns the
+       wall time taken. toggl.main resets the module's run state first, so
+       nothing carries over from a run against another dataset."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    sys.argv = ['toggl'] + argv
+    try:
+        started = time.time()
+        status = toggl.main()
+        elapsed = time.time() - started
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    if status != 0:
+        raise RuntimeError("toggl %s failed" % ' '.join(argv))
+    return elapsed
+
+def peak_memory(argv):
+    """Runs toggl.py once under tracemalloc and returns the peak traced
+       memory in bytes, or None where tracemalloc is unavailable."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        run_toggl(argv)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_point(work_dir, entries, projects, repeat):
+    """Generates (or reuses) the dataset for one size and times every
+       command on it. Returns a dict of command -> seconds and one of
+       command -> peak bytes."""
+    data_dir = os.path.join(work_dir, "e%d-p%d" % (entries, projects))
+    home = os.path.join(data_dir, "home")
+    if not os.path.exists(os.path.join(data_dir, togglgen.ENTRIES_FILE)):
+        togglgen.generate(data_dir, entries=entries, projects=projects)
+    if not os.path.exists(home):
+        os.makedirs(home)
+    f = open(os.path.join(home, ".togglrc"), "w")
+    f.write(BENCH_TOGGLRC % os.path.join(home, "cache"))
+    f.close()
+
+    projs = togglgen.read_response(os.path.join(data_dir, "projects.json"))
+    project_name = projs[len(projs) // 2]['name']
+    server, url, first, last = togglgen.serve_in_subprocess(data_dir)
+    start = time.strftime("%Y-%m-%d", time.gmtime(first)) if first is not None else "2000-01-01"
+    end = time.strftime("%Y-%m-%d", time.gmtime(last + 86400)) if last is not None else "2000-01-02"
+
+    os.environ['HOME'] = home
+    toggl.TOGGL_URL = url + "/api"
+    toggl.TOGGL_REPORTS_URL = url + "/reports"
+    timings = {}
+    peaks = {}
+    try:
+        for command in COMMANDS:
+            argv = command_args(command, start, end, project_name)
+            timings[command] = min(run_toggl(argv) for i in range(repeat))
+            peaks[command] = peak_memory(argv)
+    finally:
+        server.terminate()
+        server.join()
+    return timings, peaks
+
+def exponents(sizes, seconds):
+    """Returns the log-log slope between each pair of neighbouring sizes."""
+    slopes = []
+    for i in range(1, len(sizes)):
+        if seconds[i - 1] > 0 and seconds[i] > 0 and sizes[i] != sizes[i - 1]:
+            slopes.append(math.log(seconds[i] / seconds[i - 1]) /
+                    math.log(float(sizes[i]) / sizes[i - 1]))
+    return slopes
+
+def report(sweep, sizes, results, peaks):
+    print("%s sweep" % sweep)
+    print("%-14s %s" % ("", ' '.join("%10d" % n for n in sizes)))
+    for command in COMMANDS:
+        seconds = [results[n][command] for n in sizes]
+        slopes = exponents(sizes, seconds)
+        flag = " superlinear" if slopes and max(slopes) > SUPERLINEAR else ""
+        print("%-14s %s   exponent %s%s" % (command, ' '.join("%9.3fs" % s for s in seconds),
+            ' '.join("%.2f" % s for s in slopes) or "-", flag))
+    if tracemalloc is not None:
+        print("peak memory")
+        for command in COMMANDS:
+            mib = [peaks[n][command] / 1048576.0 for n in sizes]
+            slopes = exponents(sizes, mib)
+            flag = " superlinear" if slopes and max(slopes) > SUPERLINEAR else ""
+            print("%-14s %s   exponent %s%s" % (command, ' '.join("%7.1fMiB" % m for m in mib),
+                ' '.join("%.2f" % s for s in slopes) or "-", flag))
+    print("")
+
+def plot(path, sweeps):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("Plotting needs matplotlib (pip install matplotlib).")
+        return False
+    fig, axes = plt.subplots(1, len(sweeps), figsize=(6 * len(sweeps), 5))
+    if len(sweeps) == 1:
+        axes = [axes]
+    for ax, (sweep, sizes, results, peaks) in zip(axes, sweeps):
+        for command in COMMANDS:
+            ax.plot(sizes, [results[n][command] for n in sizes], marker='o', label=command)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel(sweep)
+        ax.set_ylabel("seconds")
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+    return True
+
+def int_list(text):
+    return [int(n) for n in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(prog='togglbench')
+    parser.add_argument('-n', '--entries', type=int_list, default=[1000, 10000, 100000],
+            help='Entry counts of the entries sweep (default 1000,10000,100000)')
+    parser.add_argument('-p', '--projects', type=int_list, default=[10, 100, 1000, 10000],
+            help='Project counts of the projects sweep (default 10,100,1000,10000)')
+    parser.add_argument('--fixed-entries', type=int, default=10000, help='Entries during the projects sweep')
+    parser.add_argument('--fixed-projects', type=int, default=100, help='Projects during the entries sweep')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per command; the fastest counts')
+    parser.add_argument('-w', '--work-dir', default='bench-data', help='Where datasets are generated and kept')
+    parser.add_argument('--csv', default=None, metavar='FILE', help='Write the timings and peak memory as CSV')
+    parser.add_argument('--plot', default=None, metavar='FILE', help='Plot the timings (needs matplotlib)')
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir)
+    sweeps = []
+    for sweep, sizes, point in [
+            ('entries', args.entries, lambda n: (n, args.fixed_projects)),
+            ('projects', args.projects, lambda n: (args.fixed_entries, n))]:
+        results = {}
+        peaks = {}
+        for n in sizes:
+            entries, projects = point(n)
+            sys.stderr.write("%d entries, %d projects...\n" % (entries, projects))
+            results[n], peaks[n] = bench_point(work_dir, entries, projects, args.repeat)
+        sweeps.append((sweep, sizes, results, peaks))
+        report(sweep, sizes, results, peaks)
+
+    if args.csv:
+        f = open(args.csv, "w")
+        writer = csv.writer(f)
+        writer.writerow(['sweep', 'command', 'entries', 'projects', 'seconds', 'peak_bytes'])
+        for sweep, sizes, results, peaks in sweeps:
+            for n in sizes:
+                entries, projects = (n, args.fixed_projects) if sweep == 'entries' \
+                        else (args.fixed_entries, n)
+                for command in COMMANDS:
+                    peak = peaks[n][command]
+                    writer.writerow([sweep, command, entries, projects,
+                        "%.6f" % results[n][command], "" if peak is None else peak])
+        f.close()
+    if args.plot and not plot(args.plot, sweeps):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: set ts=4 sw=4 tw=0 :
@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+"""
+togglgen.py
+
+Generates synthetic Toggl accounts for scaling tests, and serves them
+through a local stand-in for the parts of the API that toggl.py uses.
+
+    togglgen.py generate DIR --entries 100000 --projects 1000 [--cache CACHE]
+    togglgen.py serve DIR --port 8765
+
+A dataset directory holds workspaces.json, clients.json, projects.json,
+tasks.json and users.json as API responses, and time_entries.jsonl with one
+entry per line in start order. --cache also writes the collections as
+toggl.py cache files and the entries into the local entry store, as
+"toggl update" and "toggl sync" would.
+
+Point toggl.py at "toggl.TOGGL_URL = 'http://127.0.0.1:PORT/api'" (and
+TOGGL_REPORTS_URL at '.../reports') to run it against a served dataset.
+"""
+
+from libtoggl import *
+
+import argparse
+import array
+import bisect
+import calendar
+import datetime
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import sys
+
+import dateutil.parser as date_parser
+import pytz
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+ENTRIES_FILE = 'time_entries.jsonl'
+COLLECTIONS = ['workspaces', 'clients', 'projects', 'tasks', 'users']
+
+WORDS = ['alpha', 'apollo', 'atlas', 'beacon', 'borealis', 'cascade', 'cobalt',
+    'delta', 'ember', 'falcon', 'granite', 'harbor', 'helix', 'ion', 'juniper',
+    'keystone', 'lumen', 'meridian', 'nimbus', 'onyx', 'orion', 'pioneer',
+    'quartz', 'redwood', 'summit', 'tango', 'umbra', 'vector', 'willow', 'zenith']
+KINDS = ['Website', 'Mobile App', 'Migration', 'Audit', 'Support', 'Redesign',
+    'Backend', 'Data Pipeline', 'Onboarding', 'Research', 'Infrastructure']
+COMPANIES = ['Acme', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Stark',
+    'Wayne', 'Wonka', 'Tyrell', 'Cyberdyne', 'Soylent', 'Vandelay']
+VERBS = ['Review', 'Fix', 'Implement', 'Plan', 'Test', 'Deploy', 'Refactor',
+    'Document', 'Discuss', 'Investigate', 'Design', 'Estimate']
+NOUNS = ['login flow', 'invoice export', 'search page', 'API client',
+    'release notes', 'CI pipeline', 'database schema', 'sprint backlog',
+    'dashboard', 'payment form', 'error handling', 'onboarding emails']
+
+# Entry durations are log-normal around a 40 minute median, between one
+# minute and eight hours.
+MEDIAN_DURATION = 40 * 60
+DURATION_SIGMA = 0.9
+MIN_DURATION = 60
+MAX_DURATION = 8 * 3600
+
+def ref(obj, *keys):
+    """Returns the subset of an object embedded in related objects."""
+    return dict((k, obj[k]) for k in (KEY_ID, KEY_NAME) + keys if k in obj)
+
+def write_response(path, data):
+    f = open(path, "w")
+    json.dump({'data': data}, f)
+    f.close()
+
+def read_response(path):
+    f = open(path, "r")
+    data = json.load(f)['data']
+    f.close()
+    return data
+
+def generate_account(rng, workspaces, clients, projects, archived_ratio,
+        tasks_per_project):
+    """Returns the workspaces, clients, projects, tasks and users of an
+       account. Clients and projects are spread over the workspaces; about
+       one project in five has no client."""
+    wsps = [{KEY_ID: i + 1, KEY_NAME: "%s Workspace" % WORDS[i % len(WORDS)].title()
+                + ("" if i < len(WORDS) else " %d" % (i + 1)),
+             KEY_PROFILE: 'Pro', KEY_ISADMIN: i == 0}
+            for i in range(workspaces)]
+    clis = []
+    for i in range(clients):
+        name = COMPANIES[i % len(COMPANIES)]
+        if i >= len(COMPANIES):
+            name = "%s %d" % (name, i // len(COMPANIES) + 1)
+        wsp = wsps[i % len(wsps)]
+        clis.append({KEY_ID: 1000 + i, KEY_NAME: name, KEY_WORKSPACE: ref(wsp),
+            KEY_HRLYRATE: rng.choice([0, 50, 80, 120]), KEY_CURRENCY: 'USD'})
+    projs = []
+    tasks = []
+    for i in range(projects):
+        wsp = wsps[i % len(wsps)]
+        name = "%s %s" % (WORDS[i % len(WORDS)].title(), KINDS[(i // len(WORDS)) % len(KINDS)])
+        if i >= len(WORDS) * len(KINDS):
+            name = "%s %d" % (name, i // (len(WORDS) * len(KINDS)) + 1)
+        proj = {KEY_ID: 100000 + i, KEY_NAME: name, KEY_WORKSPACE: ref(wsp),
+            KEY_BILLABLE: rng.random() < 0.6,
+            KEY_ESTWKHRS: rng.choice([None, 20, 80, 200]),
+            KEY_AUTOCALCWH: False, KEY_ISACTIVE: rng.random() >= archived_ratio}
+        same_wsp = [c for c in clis[i % len(wsps)::len(wsps)]] if clis else []
+        if same_wsp and rng.random() < 0.8:
+            proj[KEY_CLIENT] = ref(rng.choice(same_wsp))
+        projs.append(proj)
+        for t in range(tasks_per_project):
+            tasks.append({KEY_ID: 10000000 + i * tasks_per_project + t,
+                KEY_NAME: "%s %s" % (rng.choice(VERBS), rng.choice(NOUNS)),
+                'pid': proj[KEY_ID], 'wid': wsp[KEY_ID], 'active': proj[KEY_ISACTIVE],
+                KEY_ESTSECS: rng.choice([None, 3600, 14400])})
+    users = [{KEY_ID: 1, KEY_FULLNAME: 'Synthetic User', KEY_EMAIL: 'user@example.com'}]
+    return wsps, clis, projs, tasks, users
+
+def generate_days(rng, projects, count, end, days, overlap_ratio, tz):
+    """Yields count entries spread over the weekdays of the days before end,
+       as one list per day, in day order. Each day's entries run back to
+       back from a morning start with short gaps, and fit in 20 hours so
+       days never interleave. With overlap_ratio probability an entry starts
+       before the previous one stopped, like a timer left running."""
+    active = [p for p in projects if p[KEY_ISACTIVE]] or projects
+    weekdays = []
+    day = end - datetime.timedelta(days=days)
+    while day < end:
+        if day.weekday() < 5:
+            weekdays.append(day)
+        day += datetime.timedelta(days=1)
+    if not weekdays:
+        weekdays = [end - datetime.timedelta(days=1)]
+
+    next_id = 1
+    for i, day in enumerate(weekdays):
+        # Spread the remainder over the first days.
+        per_day = count // len(weekdays) + (1 if i < count % len(weekdays) else 0)
+        start = tz.localize(datetime.datetime(day.year, day.month, day.day, 8)) + \
+                datetime.timedelta(minutes=rng.randint(0, 90))
+        proj = rng.choice(active)
+        # Busy days get shorter entries and gaps rather than spilling over.
+        budget = 16 * 3600 // max(per_day, 1)
+        entries = []
+        for n in range(per_day):
+            if rng.random() < 0.3:
+                proj = rng.choice(active)
+            duration = int(min(MAX_DURATION, max(MIN_DURATION,
+                rng.lognormvariate(math.log(MEDIAN_DURATION), DURATION_SIGMA))))
+            duration = max(1, min(duration, budget))
+            stop = start + datetime.timedelta(seconds=duration)
+            entries.append({KEY_ID: next_id,
+                KEY_DESC: "%s %s" % (rng.choice(VERBS), rng.choice(NOUNS)) +
+                    (" #%d" % rng.randint(100, 9999) if rng.random() < 0.3 else ""),
+                KEY_PROJECT: ref(proj, KEY_WORKSPACE),
+                KEY_WORKSPACE: proj[KEY_WORKSPACE],
+                KEY_START: start.astimezone(pytz.utc).isoformat(),
+                KEY_STOP: stop.astimezone(pytz.utc).isoformat(),
+                KEY_DURATION: duration, KEY_BILLABLE: proj[KEY_BILLABLE],
+                'uid': 1})
+            next_id += 1
+            if rng.random() < overlap_ratio:
+                start = stop - datetime.timedelta(seconds=rng.randint(1, duration))
+            else:
+                start = stop + datetime.timedelta(seconds=rng.randint(0, min(900, budget // 4)))
+        yield entries
+
+def generate(out_dir, entries=10000, projects=100, workspaces=2, clients=None,
+        archived_ratio=0.2, tasks_per_project=2, days=365, overlap_ratio=0.02,
+        end=None, timezone='UTC', seed=1):
+    """Writes a dataset to out_dir and returns the (start, end) dates its
+       entries span."""
+    rng = random.Random(seed)
+    tz = pytz.timezone(timezone)
+    if clients is None:
+        clients = max(1, projects // 5)
+    if end is None:
+        end = datetime.date.today()
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    account = generate_account(rng, workspaces, clients, projects,
+            archived_ratio, tasks_per_project)
+    for name, data in zip(COLLECTIONS, account):
+        write_response(os.path.join(out_dir, "%s.json" % name), data)
+
+    # Overlaps can reorder starts, so sort each day's entries before writing.
+    f = open(os.path.join(out_dir, ENTRIES_FILE), "w")
+    for day in generate_days(rng, account[2], entries, end, days, overlap_ratio, tz):
+        day.sort(key=lambda e: e[KEY_START])
+        f.writelines(json.dumps(e) + "\n" for e in day)
+    f.close()
+    return end - datetime.timedelta(days=days), end
+
+def iter_dataset_entries(data_dir):
+    f = open(os.path.join(data_dir, ENTRIES_FILE), "r")
+    try:
+        for line in f:
+            yield TogglEntry(json.loads(line))
+    finally:
+        f.close()
+
+def write_cache(data_dir, cache_path, timezone='UTC'):
+    """Writes a dataset as toggl.py cache files and entry store, the latter
+       rolled up by day in the given timezone."""
+    import toggl
+    cache = toggl.TogglCache(cache_path=cache_path, cache_enabled=True)
+    # The cache writes record statistics through the module's cache object.
+    toggl.toggl_cache = cache
+    for name in ('workspaces', 'clients', 'projects'):
+        data = read_response(os.path.join(data_dir, "%s.json" % name))
+        cache.write_records(cache._collection_file("%s.cache" % name), data)
+
+    store = cache.open_store(timezone)
+    try:
+        batch = []
+        for entry in iter_dataset_entries(data_dir):
+            batch.append(entry)
+            if len(batch) >= 10000:
+                store.upsert(batch)
+                batch = []
+        store.upsert(batch)
+    finally:
+        store.close()
+
+class TogglDataset:
+    """A generated dataset, loaded for serving. The entry file is memory
+       mapped; only the start time and offset of each line are kept."""
+
+    def __init__(self, data_dir):
+        self.collections = {}
+        for name in COLLECTIONS:
+            f = open(os.path.join(data_dir, "%s.json" % name), "rb")
+            self.collections[name] = f.read()
+            f.close()
+        self.projects = json.loads(self.collections['projects'].decode('utf-8'))['data']
+        self.clients = json.loads(self.collections['clients'].decode('utf-8'))['data']
+
+        self._file = open(os.path.join(data_dir, ENTRIES_FILE), "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.path.getsize(self._file.name) else b''
+        self.starts = array.array('d')
+        self.offsets = array.array('Q', [0])
+        pos = 0
+        while pos < len(self._map):
+            end = self._map.find(b'\n', pos)
+            if end < 0:
+                end = len(self._map)
+            # Entries are written as json.dumps of a dict whose start is an
+            # ISO UTC time, so it can be found without decoding the line.
+            key = b'"start": "'
+            at = self._map.find(key, pos, end) + len(key)
+            self.starts.append(utc_epoch(self._map[at:at + 19]))
+            self.offsets.append(end + 1)
+            pos = end + 1
+
+    def entry_lines(self, since, until):
+        """Returns the encoded entries starting in [since, until)."""
+        lo = bisect.bisect_left(self.starts, since)
+        hi = bisect.bisect_left(self.starts, until)
+        return [self._map[self.offsets[i]:self.offsets[i + 1] - 1] for i in range(lo, hi)]
+
+    def entry(self, entry_id):
+        # Ids are assigned in generation order, which is close to start
+        # order but not equal to it when entries overlap.
+        for i in range(len(self.starts)):
+            line = self._map[self.offsets[i]:self.offsets[i + 1] - 1]
+            if line.startswith(('{"id": %d,' % entry_id).encode('ascii')):
+                return line
+        return None
+
+def utc_epoch(stamp):
+    """Converts the YYYY-MM-DDTHH:MM:SS prefix of a UTC time written by
+       generate to seconds since the epoch, without a full parse."""
+    return calendar.timegm((int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+        int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19]), 0, 0, 0))
+
+def to_epoch(text):
+    """Converts a date or time sent by toggl.py to seconds since the epoch;
+       one without an offset, such as a bare date, is taken as UTC."""
+    return calendar.timegm(date_parser.parse(text).utctimetuple())
+
+class TogglDatasetHandler(BaseHTTPRequestHandler):
+    """Answers the v6 API and reports requests toggl.py sends from the
+       server's dataset. Mutations are echoed back but not stored."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, code=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_entries(self, lines):
+        self._send(b'{"data": [' + b','.join(lines) + b']}')
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8') or 'null')
+
+    def do_GET(self):
+        data = self.server.dataset
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/')
+        path = '/'.join(parts[2:]) if parts[0] == 'api' else '/'.join(parts)
+
+        # Reports requests arrive as <reports_url>/details.
+        if parts[-1] == 'details':
+            return self._send_report(data, query)
+        if path in ('workspaces.json', 'clients.json', 'projects.json', 'tasks.json'):
+            return self._send(data.collections[path[:-len('.json')]])
+        if len(parts) > 2 and parts[2] == 'workspaces' and len(parts) == 5:
+            wsp_id = int(parts[3])
+            if parts[4] == 'users.json':
+                return self._send(data.collections['users'])
+            objs = {'projects.json': data.projects, 'clients.json': data.clients}.get(parts[4])
+            if objs is not None:
+                return self._send({'data': [o for o in objs
+                    if o[KEY_WORKSPACE][KEY_ID] == wsp_id]})
+        if path == 'time_entries.json':
+            if 'start_date' in query:
+                since, until = to_epoch(query['start_date']), to_epoch(query['end_date'])
+            else:
+                # Like the API, the last nine days by default.
+                until = float(data.starts[-1]) + 1 if data.starts else 0
+                since = until - 9 * 86400
+            return self._send_entries(data.entry_lines(since, until))
+        if path.startswith('time_entries/'):
+            line = data.entry(int(parts[-1].split('.')[0]))
+            if line is not None:
+                return self._send(b'{"data": ' + line + b'}')
+        self._send({}, 404)
+
+    def _send_report(self, data, query):
+        since = to_epoch(query['since'])
+        until = to_epoch(query['until']) + 86400
+        page = int(query.get('page', 1))
+        per_page = 50
+        entries = [json.loads(line.decode('utf-8')) for line in data.entry_lines(since, until)]
+        entries = [e for e in entries
+                if str(e[KEY_WORKSPACE][KEY_ID]) == query.get('workspace_id')]
+        rows = [{KEY_ID: e[KEY_ID], 'uid': 1, 'user': 'Synthetic User',
+                'project': e[KEY_PROJECT][KEY_NAME], 'client': None,
+                KEY_DESC: e[KEY_DESC], KEY_START: e[KEY_START], 'end': e[KEY_STOP],
+                'dur': e[KEY_DURATION] * 1000}
+            for e in entries[(page - 1) * per_page:page * per_page]]
+        self._send({'data': rows, 'total_count': len(entries), 'per_page': per_page})
+
+    def do_POST(self):
+        body = self._body() or {}
+        obj = dict(list(body.values())[0]) if body else {}
+        # toggl.py sends "id": null for new objects.
+        if obj.get(KEY_ID) is None:
+            obj[KEY_ID] = random.randint(10 ** 8, 10 ** 9)
+        self._send({'data': obj})
+
+    def do_PUT(self):
+        body = self._body() or {}
+        url = urlparse(self.path).path
+        if url.endswith('/archive.json') or url.endswith('/open.json'):
+            ids = set(body.get(KEY_ID) or [])
+            projs = [dict(p, is_active=url.endswith('/open.json'))
+                    for p in self.server.dataset.projects if p[KEY_ID] in ids]
+            return self._send({'data': projs})
+        self._send({'data': list(body.values())[0] if body else None})
+
+    def do_DELETE(self):
+        self._send({'data': None})
+
+class TogglDatasetServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), TogglDatasetHandler)
+        self.dataset = dataset
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+def serve_child(data_dir, port, ready):
+    server = TogglDatasetServer(TogglDataset(data_dir), port)
+    starts = server.dataset.starts
+    ready.put((server.url, starts[0] if starts else None, starts[-1] if starts else None))
+    server.serve_forever()
+
+def serve_in_subprocess(data_dir, port=0):
+    """Starts a server for the dataset in a child process, so that its
+       memory and CPU time stay out of measurements taken in the caller.
+       Returns the process, the server URL and the first and last entry
+       start times (None if there are no entries). Terminate the process
+       when done."""
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_child, args=(data_dir, port, ready))
+    process.daemon = True
+    process.start()
+    url, first, last = ready.get()
+    return process, url, first, last
+
+def main():
+    parser = argparse.ArgumentParser(prog='togglgen')
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_gen = subparsers.add_parser('generate', help='Generate a dataset')
+    parser_gen.add_argument('dir', help='Directory to write the dataset to')
+    parser_gen.add_argument('-n', '--entries', type=int, default=10000, help='Number of time entries')
+    parser_gen.add_argument('-p', '--projects', type=int, default=100, help='Number of projects')
+    parser_gen.add_argument('-w', '--workspaces', type=int, default=2, help='Number of workspaces')
+    parser_gen.add_argument('-c', '--clients', type=int, default=None, help='Number of clients (default: projects / 5)')
+    parser_gen.add_argument('-a', '--archived-ratio', type=float, default=0.2, help='Share of archived projects')
+    parser_gen.add_argument('-t', '--tasks-per-project', type=int, default=2, help='Tasks per project')
+    parser_gen.add_argument('-d', '--days', type=int, default=365, help='Days of history')
+    parser_gen.add_argument('-o', '--overlap-ratio', type=float, default=0.02, help='Share of entries overlapping the previous one')
+    parser_gen.add_argument('-z', '--timezone', default='UTC', help='Time zone of the working day')
+    parser_gen.add_argument('-s', '--seed', type=int, default=1, help='Random seed')
+    parser_gen.add_argument('--cache', default=None, metavar='DIR', help='Also write toggl.py cache files and entry store to DIR')
+
+    parser_serve = subparsers.add_parser('serve', help='Serve a dataset as a local API')
+    parser_serve.add_argument('dir', help='Dataset directory')
+    parser_serve.add_argument('--port', type=int, default=8765)
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        start, end = generate(args.dir, args.entries, args.projects, args.workspaces,
+                args.clients, args.archived_ratio, args.tasks_per_project, args.days,
+                args.overlap_ratio, timezone=args.timezone, seed=args.seed)
+        print("Entries span %s to %s." % (start, end))
+        if args.cache:
+            write_cache(args.dir, args.cache, args.timezone)
+    elif args.command == 'serve':
+        server = TogglDatasetServer(TogglDataset(args.dir), args.port)
+        print("Serving %s at %s/api (reports: %s/reports)" % (args.dir, server.url, server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# vim: set ts=4 sw=4 tw=0 :